@@ -0,0 +1,59 @@
+import asyncio
+from typing import Optional
+import httpx
+from sensitive import API_SERVER_URL
+
+
+# connection pool / timeout settings for the auth API server
+AUTH_MAX_CONNECTIONS = 50
+AUTH_MAX_KEEPALIVE_CONNECTIONS = 20
+AUTH_KEEPALIVE_EXPIRY = 30.0
+AUTH_CONNECT_TIMEOUT = 3.0
+AUTH_READ_TIMEOUT = 5.0
+
+# max number of token validations in flight at the same time
+AUTH_MAX_CONCURRENCY = 50
+
+
+class AuthClient:
+    """Async client for the API server's user info endpoint.
+
+    Keeps one pooled keep-alive connection set for the whole process so that token validation
+    never blocks the event loop and never opens a new TCP/TLS connection per request.
+    """
+
+    def __init__(self, url: str = API_SERVER_URL):
+        self.url = url
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore = asyncio.Semaphore(AUTH_MAX_CONCURRENCY)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(AUTH_READ_TIMEOUT, connect=AUTH_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=AUTH_MAX_CONNECTIONS,
+                    max_keepalive_connections=AUTH_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=AUTH_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self._client
+
+    async def fetch_info(self, access_token: str) -> dict:
+        # returns raw "info" dict from the API server, raises on any failure
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        async with self._semaphore:
+            response = await self._get_client().get(self.url, headers=headers)
+
+        response.raise_for_status()
+        data = response.json()
+        return data["data"]["info"]
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+auth_client = AuthClient()
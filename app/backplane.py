@@ -0,0 +1,192 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import urlparse
+from app.fast_json import dumps, loads
+
+
+# pub/sub channel shared by every worker and node
+BACKPLANE_CHANNEL = "chatserver:events"
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10
+
+MessageHandler = Callable[[dict], Awaitable[None]]
+
+
+class Backplane:
+    """Fan-out of websocket events between server processes.
+
+    Every published message is delivered to the handler of every started backplane, including the
+    publisher's own, so handlers filter out their own messages.
+    """
+
+    async def start(self, handler: MessageHandler):
+        raise NotImplementedError
+
+    async def publish(self, message: dict):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InProcessBackplane(Backplane):
+    """Backplane for a single process, fans out to backplanes started in the same process"""
+
+    _handlers: List[MessageHandler] = []
+
+    def __init__(self):
+        self._handler: Optional[MessageHandler] = None
+
+    async def start(self, handler: MessageHandler):
+        self._handler = handler
+        InProcessBackplane._handlers.append(handler)
+
+    async def publish(self, message: dict):
+        for handler in list(InProcessBackplane._handlers):
+            try:
+                await handler(message)
+            except Exception as e:
+                print(f"Backplane handler error: {e}")
+
+    async def close(self):
+        if self._handler in InProcessBackplane._handlers:
+            InProcessBackplane._handlers.remove(self._handler)
+        self._handler = None
+
+
+class RedisBackplane(Backplane):
+    """Backplane over the redis protocol (PUBLISH / SUBSCRIBE), works with redis and compatible servers"""
+
+    def __init__(self, url: str, channel: str = BACKPLANE_CHANNEL):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.channel = channel
+
+        self._handler: Optional[MessageHandler] = None
+        self._subscriber_task: Optional[asyncio.Task] = None
+        self._publisher: Optional[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = None
+        self._publish_lock = asyncio.Lock()
+        self._subscribed = asyncio.Event()
+
+    async def start(self, handler: MessageHandler):
+        self._handler = handler
+        self._subscriber_task = asyncio.create_task(self._subscribe_forever())
+        # waits for the first subscription so messages published right after startup aren't missed
+        await asyncio.wait_for(self._subscribed.wait(), timeout=RECONNECT_MAX_DELAY)
+
+    async def publish(self, message: dict):
+        payload = dumps(message)
+
+        async with self._publish_lock:
+            # one reconnect attempt, a broken publisher connection is found out on write
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = await self._connect()
+                    reader, writer = self._publisher
+                    writer.write(_encode_command("PUBLISH", self.channel, payload))
+                    await writer.drain()
+                    await _read_reply(reader)
+                    return
+                except (OSError, asyncio.IncompleteReadError, ConnectionError) as e:
+                    self._close_publisher()
+                    if attempt:
+                        print(f"Backplane publish failed: {e}")
+
+    async def close(self):
+        if self._subscriber_task is not None:
+            self._subscriber_task.cancel()
+            try:
+                await self._subscriber_task
+            except asyncio.CancelledError:
+                pass
+            self._subscriber_task = None
+        self._close_publisher()
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode_command("AUTH", self.password))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    def _close_publisher(self):
+        if self._publisher is not None:
+            self._publisher[1].close()
+            self._publisher = None
+
+    async def _subscribe_forever(self):
+        delay = RECONNECT_DELAY
+        while True:
+            writer = None
+            try:
+                reader, writer = await self._connect()
+                writer.write(_encode_command("SUBSCRIBE", self.channel))
+                await writer.drain()
+                await _read_reply(reader)  # subscribe confirmation
+                self._subscribed.set()
+                delay = RECONNECT_DELAY
+
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                        await self._dispatch(reply[2])
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Backplane subscriber disconnected: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            finally:
+                if writer is not None:
+                    writer.close()
+
+    async def _dispatch(self, payload: bytes):
+        try:
+            await self._handler(loads(payload))
+        except Exception as e:
+            print(f"Backplane handler error: {e}")
+
+
+def create_backplane(url: Optional[str]) -> Backplane:
+    # redis://[:password@]host:port enables cross process fan-out, nothing means single process
+    if url:
+        return RedisBackplane(url)
+    return InProcessBackplane()
+
+
+def _encode_command(*args: str) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg.encode() if isinstance(arg, str) else arg
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise ConnectionError(rest.decode(errors="replace"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+
+    raise ConnectionError(f"Unexpected reply: {line!r}")
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class TTLCache:
+    """Bounded in-memory cache with per-entry expiry and LRU eviction."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class LoadGuard:
+    """Base (or companion, next to a TTLCache) for caches filled from firestore reads that can race with writes.
+
+    begin_load is called before the read; a write meanwhile calls invalidate_load, and finish_load
+    then tells the cache not to store what was read.
+    """
+
+    def __init__(self):
+        # keys being loaded -> whether they were written meanwhile
+        self._loading: Dict[Hashable, bool] = {}
+
+    def begin_load(self, key: Hashable):
+        self._loading.setdefault(key, False)
+
+    def cancel_load(self, key: Hashable):
+        self._loading.pop(key, None)
+
+    def invalidate_load(self, key: Hashable):
+        if key in self._loading:
+            self._loading[key] = True
+
+    def finish_load(self, key: Hashable) -> bool:
+        # True when the loaded value may be stored, False if it was written meanwhile or never began loading
+        return not self._loading.pop(key, True)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one underlying call.
+
+    The call runs in its own task, so a cancelled caller doesn't cancel it for the others.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+        # marks the exception as retrieved when every caller has gone away
+        if not task.cancelled():
+            task.exception()
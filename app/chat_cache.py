@@ -0,0 +1,98 @@
+import json
+from collections import OrderedDict, deque
+from app.cache import LoadGuard
+
+
+# last chats of recently opened rooms, so re-opening a hot room needs no firestore read
+RECENT_CHATS_PER_ROOM = 50
+RECENT_CHATS_MAX_ROOMS = 1000
+RECENT_CHATS_MAX_BYTES = 64 * 1024 * 1024
+
+
+class _RoomBuffer:
+    def __init__(self, maxlen: int):
+        self.chats: deque = deque(maxlen=maxlen)
+        self.has_more = False
+        self.size = 0
+
+
+class RecentChatsCache(LoadGuard):
+    """Per room ring buffer of the latest chats with LRU eviction across rooms.
+
+    Memory is capped both by room count and by the approximate json size of all buffered chats.
+    """
+
+    def __init__(self, per_room: int, max_rooms: int, max_bytes: int):
+        super().__init__()
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self._rooms: "OrderedDict[str, _RoomBuffer]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, room_id: str):
+        # returns (chats, has_more) or None when the room isn't buffered
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            self.misses += 1
+            return None
+
+        self._rooms.move_to_end(room_id)
+        self.hits += 1
+        return [chat for chat, _ in buffer.chats], buffer.has_more
+
+    def fill(self, room_id: str, chats: list, has_more: bool):
+        # stores the latest page loaded from firestore
+        if not self.finish_load(room_id):
+            return
+
+        self.discard(room_id)
+
+        buffer = _RoomBuffer(self.per_room)
+        self._rooms[room_id] = buffer
+        for chat in chats[-self.per_room :]:
+            self._push(buffer, chat)
+        buffer.has_more = has_more or len(chats) > self.per_room
+
+        self._evict()
+
+    def append(self, room_id: str, chat: dict):
+        # only rooms already buffered are extended, otherwise the buffer wouldn't hold the latest chats in full
+        self.invalidate_load(room_id)
+
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            return
+
+        if len(buffer.chats) == buffer.chats.maxlen:
+            _, oldest_size = buffer.chats[0]
+            buffer.size -= oldest_size
+            self._size -= oldest_size
+            buffer.has_more = True
+
+        self._push(buffer, chat)
+        self._evict()
+
+    def discard(self, room_id: str):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self._size -= buffer.size
+
+    def _push(self, buffer: _RoomBuffer, chat: dict):
+        size = len(json.dumps(chat, ensure_ascii=False, default=str))
+        buffer.chats.append((chat, size))
+        buffer.size += size
+        self._size += size
+
+    def _evict(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self._size > self.max_bytes):
+            _, buffer = self._rooms.popitem(last=False)
+            self._size -= buffer.size
+
+    def stats(self) -> dict:
+        return {"rooms": len(self._rooms), "bytes": self._size, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
+
+
+recent_chats = RecentChatsCache(per_room=RECENT_CHATS_PER_ROOM, max_rooms=RECENT_CHATS_MAX_ROOMS, max_bytes=RECENT_CHATS_MAX_BYTES)
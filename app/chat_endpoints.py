@@ -1,13 +1,22 @@
 # app/api/endpoints.py
+import asyncio
 from fastapi import APIRouter, Request
 from fastapi import File, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
-import uuid
 
+from typing import Optional
 from pydantic import BaseModel
-from app.utils import send_single_sms
-from firebase_instance import database, bucket
-from firebase_admin import messaging
+from app.utils import user_info_cache, user_info_flight
+from app.sms import sms_dispatcher
+from app.uploads import UPLOAD_MAX_SIZE, create_signed_upload, finalize_upload, store_upload
+from app.chat_cache import recent_chats
+from app.html_cache import html_cache
+from app.html_edtor_endpoints import htmls_count_cache
+from app.order_usim_endpoints import orders_count_cache
+from websocket_manager import manager
+from app.notifications import fcm_tokens_cache, notification_dispatcher
+from app.sign_registry import SIGN_WAIT_MAX_TIMEOUT, SIGN_WAIT_TIMEOUT, sign_registry
+from firebase_instance import database, run_db
 from google.cloud.firestore_v1.base_query import FieldFilter
 
 router = APIRouter()
@@ -18,6 +27,23 @@ async def root():
     return {"message": "Hi there"}
 
 
+@router.get("/stats")
+async def stats():
+    # in-memory cache counters of this worker
+    return {
+        "user_info_cache": {**user_info_cache.stats(), "shared_calls": user_info_flight.shared},
+        "recent_chats": recent_chats.stats(),
+        "htmls_count_cache": htmls_count_cache.stats(),
+        "html_cache": html_cache.stats(),
+        "orders_count_cache": orders_count_cache.stats(),
+        "websockets": manager.stats(),
+        "notifications": notification_dispatcher.stats(),
+        "fcm_tokens_cache": fcm_tokens_cache.stats(),
+        "sms": sms_dispatcher.stats(),
+        "sign_registry": sign_registry.stats(),
+    }
+
+
 # @router.post("/get-room-count")
 # async def get_room_info(request: Request):
 #     data = await request.json()
@@ -44,28 +70,50 @@ async def root():
 
 
 @router.post("/upload")
-async def upload_file(file: UploadFile = File(..., max_size=1024 * 1024 * 10)):
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="File has no filename")
+async def upload_file(file: UploadFile = File(..., max_size=UPLOAD_MAX_SIZE)):
+    try:
+        # streams the file to storage under its content hash, identical files share one blob
+        uploaded = await store_upload(file, "attachments/")
+        return JSONResponse(content=uploaded, status_code=200)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
+
+class UploadUrlData(BaseModel):
+    prefix: str  # "attachments" or "html_images"
+    filename: str
+    content_type: str
+    sha256: Optional[str] = None
+
+
+@router.post("/create-upload-url")
+async def create_upload_url(data: UploadUrlData):
+    # client PUTs the file straight to storage with upload_url and upload_headers, then calls /finalize-upload with object_path
     try:
-        # generates a unique filename
-        filename = f"{uuid.uuid4()}.{file.filename.split('.')[-1]}"
+        signed_upload = await create_signed_upload(data.prefix, data.filename, data.content_type, data.sha256)
+        return JSONResponse(content=signed_upload, status_code=200)
 
-        # creates a blob in the bucket and upload the file data
-        blob = bucket.blob("attachments/" + filename)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
-        # reads the file content
-        content = await file.read()
 
-        # uploads the file to Firebase Storage
-        blob.upload_from_string(content, content_type=file.content_type)
+class FinalizeUploadData(BaseModel):
+    path: str
 
-        # makes the blob publicly accessible (optional)
-        blob.make_public()
 
-        return JSONResponse(content={"filename": filename, "path": blob.public_url}, status_code=200)
+@router.post("/finalize-upload")
+async def finalize_direct_upload(data: FinalizeUploadData):
+    try:
+        uploaded = await finalize_upload(data.path)
+        return JSONResponse(content=uploaded, status_code=200)
 
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -79,24 +127,30 @@ class SMSData(BaseModel):
 
 
 @router.post("/send-single-sms")
-def send_sms(sms_data: SMSData):
-    # async def send_sms(request: Request):
+async def send_sms(sms_data: SMSData):
+
+    # refused before the sign_data doc is written, so a full queue leaves nothing behind
+    if sms_dispatcher.full():
+        raise HTTPException(status_code=503, detail="SMS queue is full, try again later")
 
     sign_data_ref = database.collection("sign_data").document()
     doc_id = sign_data_ref.id
 
-    sign_data_ref.set(
+    await run_db(
+        sign_data_ref.set,
         {
             "partner_code": sms_data.partner_code,
             "sign_data": None,
             "seal_data": None,
-        }
+        },
     )
+    sign_registry.register(doc_id, sms_data.partner_code)
 
     try:
         full_message = f"{sms_data.message}\n\n{sms_data.base_url}{doc_id}"
 
-        send_single_sms(
+        # delivered in the background, the key is returned right away
+        sms_dispatcher.send(
             receiver_phone_number=sms_data.receiver_phone_number,
             title=sms_data.title,
             message=full_message,
@@ -110,6 +164,12 @@ def send_sms(sms_data: SMSData):
             }
         )
 
+    except asyncio.QueueFull:
+        # filled up while the doc was being written
+        sign_registry.discard(doc_id)
+        await run_db(sign_data_ref.delete)
+        raise HTTPException(status_code=503, detail="SMS queue is full, try again later")
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
@@ -133,10 +193,17 @@ async def save_sign(request: Request):
         return fail_response
 
     sign_seal_data_ref = database.collection("sign_data").document(key)
-    sign_seal_data = sign_seal_data_ref.get().to_dict()
+    sign_seal_data = (await run_db(sign_seal_data_ref.get)).to_dict()
 
     if sign_seal_data is not None:
-        sign_seal_data_ref.set({"sign_data": sign_data, "seal_data": seal_data})
+        await run_db(sign_seal_data_ref.set, {"sign_data": sign_data, "seal_data": seal_data}, merge=True)
+
+        # wakes up /wait-sign clients on every worker and tells the partner's sockets
+        await sign_registry.complete(key, sign_data, seal_data)
+        partner_code = sign_seal_data.get("partner_code")
+        if partner_code:
+            await manager.send_json_to_identifier({"type": "sign_completed", "key": key}, partner_code)
+
         return JSONResponse(
             content={
                 "message": "서명 완료",
@@ -162,48 +229,75 @@ async def check_sign(request: Request):
     if key is None or key == "":
         return fail_response
 
-    sign_seal_data_ref = database.collection("sign_data").document(key)
+    sign_seal_data = (await run_db(database.collection("sign_data").document(key).get)).to_dict()
+    return await take_sign(key, sign_seal_data) or fail_response
 
-    if sign_seal_data_ref.get().exists:
-        sign_seal_data = sign_seal_data_ref.get().to_dict()
 
-        if sign_seal_data is not None:
-            sign_data = sign_seal_data["sign_data"]
-            seal_data = sign_seal_data["seal_data"]
+class WaitSignData(BaseModel):
+    key: str
+    timeout: Optional[float] = SIGN_WAIT_TIMEOUT
 
-            if sign_data is not None and seal_data is not None:
-                sign_seal_data_ref.delete()
 
-                return JSONResponse(
-                    content={
-                        "message": "서명 완료",
-                        "success": True,
-                        "sign_data": sign_data,
-                        "seal_data": seal_data,
-                    }
-                )
+@router.post("/wait-sign")
+async def wait_sign(data: WaitSignData):
+    # long-poll version of /check-sign, answers as soon as /save-sign completes the key.
+    # on timeout the client just calls again, waiting costs no firestore reads
+    fail_response = JSONResponse(
+        content={
+            "message": "서명이 완료되지 않았습니다",
+            "success": False,
+        }
+    )
 
-    return fail_response
+    if not data.key:
+        return fail_response
 
+    # key unknown to this worker (restart, other worker), checked once before waiting
+    if not sign_registry.is_pending(data.key):
+        sign_seal_data = (await run_db(database.collection("sign_data").document(data.key).get)).to_dict()
+        if sign_seal_data is None:
+            return fail_response
 
-def send_multiple_notifications(fcm_tokens, title, body, chat_room_id):
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        data={
-            # "room": room,
-            "chat_room_id": chat_room_id,
-        },
-        tokens=fcm_tokens,
-    )
+        signed_response = await take_sign(data.key, sign_seal_data)
+        if signed_response is not None:
+            return signed_response
+        sign_registry.register(data.key, sign_seal_data.get("partner_code"))
 
-    try:
-        response = messaging.send_multicast(message)
-        return f"Successfully sent messages: {response.success_count} successful, {response.failure_count} failed"
-    except Exception as e:
-        return f"Error sending messages: {e}"
+    timeout = min(max(data.timeout or SIGN_WAIT_TIMEOUT, 0), SIGN_WAIT_MAX_TIMEOUT)
+    pending = await sign_registry.wait(data.key, timeout)
+    if pending is None:
+        return fail_response
+
+    # completed on this worker the data is at hand, otherwise read once
+    sign_seal_data = pending.data
+    if sign_seal_data is None:
+        sign_seal_data = (await run_db(database.collection("sign_data").document(data.key).get)).to_dict()
+
+    return await take_sign(data.key, sign_seal_data) or fail_response
+
+
+async def take_sign(key: str, sign_seal_data: Optional[dict]) -> Optional[JSONResponse]:
+    # returns the completed signature and removes it, None while it isn't signed yet
+    if sign_seal_data is None:
+        return None
+
+    sign_data = sign_seal_data.get("sign_data")
+    seal_data = sign_seal_data.get("seal_data")
+
+    if sign_data is None or seal_data is None:
+        return None
+
+    await run_db(database.collection("sign_data").document(key).delete)
+    sign_registry.discard(key)
+
+    return JSONResponse(
+        content={
+            "message": "서명 완료",
+            "success": True,
+            "sign_data": sign_data,
+            "seal_data": seal_data,
+        }
+    )
 
 
 # from enum import Enum
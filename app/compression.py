@@ -0,0 +1,17 @@
+import gzip
+from typing import Dict
+
+# brotli is optional, without it only gzip variants are made.
+# runs in pool workers, so nothing here may import firebase_instance
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+def compress_variants(body: bytes) -> Dict[str, bytes]:
+    # runs in a worker process, high levels are affordable since it happens once per save
+    variants = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11, mode=brotli.MODE_TEXT)
+    return variants
@@ -0,0 +1,38 @@
+import json
+from typing import Any
+from fastapi.responses import JSONResponse
+
+# orjson is optional, stdlib json is used when it isn't installed
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+# datetimes and dataclasses go through default like in the stdlib branch, so the output doesn't
+# depend on orjson being installed (firestore's DatetimeWithNanoseconds would fail otherwise)
+_ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS) if orjson is not None else 0
+
+
+def dumps_bytes(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=str, option=_ORJSON_OPTIONS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def dumps(content: Any) -> str:
+    # text websocket frames and backplane payloads
+    return dumps_bytes(content).decode("utf-8")
+
+
+def loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when available"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_bytes(content)
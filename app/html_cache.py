@@ -0,0 +1,141 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Optional
+from app.cache import LoadGuard
+from websocket_manager import manager
+
+
+# rendered /get-html responses, policy pages are read far more often than they are saved
+HTML_CACHE_MAX_ENTRIES = 1000
+HTML_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+
+def html_etag(html_id: str, html: dict) -> str:
+    # from id, revision and updatedAt, so the document rendered on any worker gets the same tag.
+    # weak, the same tag stands for the identity and the compressed bodies.
+    # strftime keeps the wall clock digits of both the naive saved and the utc firestore datetime
+    updated_at = html.get("updatedAt")
+    version = f"{html_id}:{html.get('revision', 0)}:{updated_at.strftime('%Y-%m-%dT%H:%M:%S.%f') if updated_at else ''}"
+    return f'W/"{hashlib.sha256(version.encode()).hexdigest()[:32]}"'
+
+
+class CachedHtml:
+    def __init__(self, etag: str, body: bytes):
+        self.etag = etag
+        self.body = body
+        # content-encoding -> precompressed body, filled in the background
+        self.variants: Dict[str, bytes] = {}
+        self.compressing = False
+        self.size = len(body)
+
+
+class HtmlCache(LoadGuard):
+    """LRU of rendered /get-html bodies with their ETag, capped by entry count and total bytes.
+
+    Entries are dropped on save / delete on every worker through the backplane.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedHtml]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, html_id: str) -> Optional[CachedHtml]:
+        entry = self._entries.get(html_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(html_id)
+        self.hits += 1
+        return entry
+
+    def fill(self, html_id: str, etag: str, body: bytes) -> CachedHtml:
+        # returns the entry even when it isn't kept, the response still uses its ETag
+        entry = CachedHtml(etag, body)
+        if not self.finish_load(html_id):
+            return entry
+
+        self._store(html_id, entry)
+        return entry
+
+    def put(self, html_id: str, etag: str, body: bytes) -> CachedHtml:
+        # body rendered from a document just saved, replaces whatever is cached or being loaded
+        self.discard(html_id)
+        entry = CachedHtml(etag, body)
+        self._store(html_id, entry)
+        return entry
+
+    def add_variants(self, html_id: str, entry: CachedHtml, variants: Dict[str, bytes]):
+        entry.variants = variants
+        added = sum(len(variant) for variant in variants.values())
+        entry.size += added
+
+        # the entry may have been replaced or evicted while compressing
+        if self._entries.get(html_id) is entry:
+            self._size += added
+            self._evict()
+
+    def _store(self, html_id: str, entry: CachedHtml):
+        if entry.size > self.max_bytes:
+            return
+
+        old = self._entries.pop(html_id, None)
+        if old is not None:
+            self._size -= old.size
+
+        self._entries[html_id] = entry
+        self._size += entry.size
+        self._evict()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.size
+
+    def discard(self, html_id: str):
+        self.invalidate_load(html_id)
+
+        entry = self._entries.pop(html_id, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+        }
+
+
+html_cache = HtmlCache(max_entries=HTML_CACHE_MAX_ENTRIES, max_bytes=HTML_CACHE_MAX_BYTES)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match may list several tags, weak comparison as http requires for it
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag.removeprefix("W/") in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+async def invalidate_html(html_id: str):
+    html_cache.discard(html_id)
+    await manager.broadcast_event("html_changed", {"id": html_id, "node": manager.node_id})
+
+
+async def _on_html_changed(data: dict):
+    if data.get("node") != manager.node_id:
+        html_cache.discard(data["id"])
+
+
+manager.on_event("html_changed", _on_html_changed)
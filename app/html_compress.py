@@ -0,0 +1,67 @@
+import asyncio
+from typing import Dict, Optional, Set
+from app.compression import compress_variants
+from app.html_cache import CachedHtml, html_cache
+from app.process_pool import ProcessPool
+
+
+COMPRESS_WORKERS = 2
+COMPRESS_TIMEOUT = 30
+# small bodies aren't worth a variant
+COMPRESS_MIN_SIZE = 1024
+
+# preferred first when the client accepts several
+ENCODINGS = ("br", "gzip")
+
+compress_pool = ProcessPool(max_workers=COMPRESS_WORKERS)
+_compress_tasks: Set[asyncio.Task] = set()
+
+
+def shutdown_compress_pool():
+    for task in _compress_tasks:
+        task.cancel()
+    compress_pool.shutdown()
+
+
+async def _compress_entry(html_id: str, entry: CachedHtml):
+    try:
+        variants = await compress_pool.run(compress_variants, entry.body, timeout=COMPRESS_TIMEOUT)
+    except Exception as e:
+        print(f"Error compressing html {html_id}: {e}")
+        return
+    finally:
+        entry.compressing = False
+
+    # variants larger than the body itself are no use
+    html_cache.add_variants(html_id, entry, {encoding: variant for encoding, variant in variants.items() if len(variant) < len(entry.body)})
+
+
+def precompress(html_id: str, entry: CachedHtml):
+    """Compresses a cached /get-html body in the background, later responses then serve the variants"""
+    if entry.variants or entry.compressing or entry.size < COMPRESS_MIN_SIZE:
+        return
+
+    entry.compressing = True
+    task = asyncio.create_task(_compress_entry(html_id, entry))
+    _compress_tasks.add(task)
+    task.add_done_callback(_compress_tasks.discard)
+
+
+def choose_encoding(accept_encoding: Optional[str], variants: Dict[str, bytes]) -> Optional[str]:
+    # encoding of a variant the client accepts (q > 0), None for the identity body
+    if not accept_encoding or not variants:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        params = params.strip()
+        try:
+            qualities[coding.strip().lower()] = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            continue
+
+    for encoding in ENCODINGS:
+        if encoding in variants and qualities.get(encoding, qualities.get("*", 0)) > 0:
+            return encoding
+    return None
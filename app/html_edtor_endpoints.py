@@ -1,20 +1,70 @@
 # app/api/endpoints.py
 import datetime
 import sys
-from typing import Optional
+from typing import List, Optional
 from fastapi import APIRouter, Request
 from fastapi import File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
-import uuid
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
-from app.utils import format_date, get_user_info
-from firebase_instance import database, bucket
+from app.cache import TTLCache
+from app.fast_json import FastJSONResponse, dumps_bytes
+from app.html_cache import CachedHtml, etag_matches, html_cache, html_etag, invalidate_html
+from app.html_compress import choose_encoding, precompress
+from app.html_revisions import StaleRevisionError, commit_patch, commit_save, content_fields, delete_revisions, load_revision
+from app.uploads import UPLOAD_MAX_SIZE, store_upload
+from app.utils import decode_page_token, encode_page_token, format_date, get_user_info, page_cursor
+from firebase_instance import database, run_db
+from websocket_manager import manager
 from firebase_admin import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 
 
 router = APIRouter()
 
+# total_count of /get-htmls per filter combination, cleared whenever a document is saved or deleted
+HTMLS_COUNT_TTL = 300
+htmls_count_cache = TTLCache(maxsize=1000, ttl=HTMLS_COUNT_TTL)
+
+
+async def clear_htmls_count():
+    # every worker keeps its own counts
+    htmls_count_cache.clear()
+    await manager.broadcast_event("htmls_count_changed", {"node": manager.node_id})
+
+
+async def _on_htmls_count_changed(data: dict):
+    if data.get("node") != manager.node_id:
+        htmls_count_cache.clear()
+
+
+manager.on_event("htmls_count_changed", _on_htmls_count_changed)
+
+
+# fields /get-htmls filters by, cached counts only go stale when one of them changes
+HTML_FILTER_FIELDS = ("carrierType", "selectedAgent", "selectedMvnos", "policyDateMonth")
+
+
+# fields /get-htmls reads in summary mode, everything but the html content
+HTML_SUMMARY_FIELDS = [
+    "id",
+    "title",
+    "creator",
+    "updatedAt",
+    "createdAt",
+    "carrierType",
+    "selectedAgent",
+    "policyDateMonth",
+    "selectedMvnos",
+    "contentSize",
+    "contentHash",
+    "revision",
+]
+
+
+def _filter_value(value: Optional[str]) -> Optional[str]:
+    # same emptiness rule the query uses, so "" and " " share a cache entry with None
+    return value if value and value.strip() else None
+
 
 class HtmlsModel(BaseModel):
     access_token: Optional[str] = None
@@ -24,6 +74,10 @@ class HtmlsModel(BaseModel):
     policy_date_month: Optional[str] = None
     per_page: Optional[int] = 100
     page_number: Optional[int] = 1
+    # next_page_token of the previous response, page_number is only used when this is empty
+    page_token: Optional[str] = None
+    # leaves out content, documents saved before contentSize / contentHash existed return None for them
+    summary: Optional[bool] = False
 
 
 @router.post("/get-htmls")
@@ -56,13 +110,41 @@ async def get_htmls(data: HtmlsModel):
 
         # adds ordering before pagination
         query = query.order_by("createdAt", direction=firestore.Query.DESCENDING)
-        total_count = query.count().get()[0][0].value
 
-        docs = query.limit(data.per_page).offset((data.page_number - 1) * data.per_page).get()
+        count_key = (
+            _filter_value(data.carrier_type),
+            _filter_value(data.selected_agent),
+            _filter_value(data.selected_mvno),
+            _filter_value(data.policy_date_month),
+        )
+        total_count = htmls_count_cache.get(count_key)
+        if total_count is None:
+            total_count = (await run_db(query.count().get))[0][0].value
+            htmls_count_cache.set(count_key, total_count)
+
+        # keyset pagination when a page token is given, offset pagination as fallback
+        num = (data.page_number - 1) * data.per_page
+        if data.page_token:
+            try:
+                after_id, num, after_created_at = decode_page_token(data.page_token)
+            except ValueError as e:
+                return JSONResponse(content={"error": str(e)}, status_code=400)
+
+            after_ref = await page_cursor(database.collection("htmls"), after_id, "createdAt", after_created_at)
+            if after_ref is None:
+                return JSONResponse(content={"error": "Invalid page token"}, status_code=400)
+            page_query = query.start_after(after_ref)
+        else:
+            page_query = query.offset(num)
+
+        # projection, the potentially huge content field isn't read or sent
+        if data.summary:
+            page_query = page_query.select(HTML_SUMMARY_FIELDS)
+
+        docs = await run_db(page_query.limit(data.per_page).get)
 
         # process results
         htmls = []
-        num = (data.page_number - 1) * data.per_page
         for doc_ref in docs:
             num = num + 1
             html = doc_ref.to_dict()
@@ -74,12 +156,16 @@ async def get_htmls(data: HtmlsModel):
                     "carrierType": html.get("carrierType"),
                     "selectedAgent": html.get("selectedAgent"),
                     "selectedMvnos": html.get("selectedMvnos"),
+                    "contentSize": html.get("contentSize"),
+                    "contentHash": html.get("contentHash"),
                     "num": num,
                 }
             )
             htmls.append(html)
 
-        return JSONResponse(content={"htmls": htmls, "total_count": total_count}, status_code=200)
+        next_page_token = encode_page_token(docs[-1].id, num, docs[-1].get("createdAt")) if len(docs) == data.per_page else None
+
+        return FastJSONResponse(content={"htmls": htmls, "total_count": total_count, "next_page_token": next_page_token}, status_code=200)
 
     except Exception as e:
         print(e)
@@ -107,7 +193,7 @@ async def save_html_string(data: HtmlModel):
     try:
 
         # print(data.model_dump())
-        has_access, user_name = check_role(data.access_token)
+        has_access, user_name = await check_role(data.access_token)
 
         if not has_access:
             return JSONResponse(content={"success": False, "message": "접근이 허용되지 않습니다!"}, status_code=200)
@@ -115,11 +201,10 @@ async def save_html_string(data: HtmlModel):
         if not data.html_string:
             raise HTTPException(status_code=400, detail="모든 필드가 채워지지 않았습니다!")
 
-        html_data_ref = database.collection("htmls").document(data.id)
-        html_data = html_data_ref.get().to_dict()
+        html_id = database.collection("htmls").document(data.id).id
 
         new_html_content = {
-            "id": html_data_ref.id,
+            "id": html_id,
             "title": data.title,
             "creator": user_name,
             "content": data.html_string,
@@ -128,25 +213,116 @@ async def save_html_string(data: HtmlModel):
             "selectedAgent": data.selected_agent,
             "policyDateMonth": data.policy_date_month,
             "selectedMvnos": data.selected_mvnos,
+            **content_fields(data.html_string),
         }
 
-        if html_data:
-            # update current document
+        # full saves are the next revision too, stored in htmls/{id}/revisions as a diff or a snapshot
+        try:
+            html_data, saved_html = await run_db(commit_save, database.transaction(), html_id, new_html_content, user_name)
+        except PermissionError:
             # if created user and updated users are not same, returns access error
-            if user_name != html_data.get("creator", None):
-                return JSONResponse(content={"success": False, "message": "업데이트 권한이 부여되지 않았습니다."}, status_code=200)
+            return JSONResponse(content={"success": False, "message": "업데이트 권한이 부여되지 않았습니다."}, status_code=200)
 
-            html_data_ref.update(new_html_content)
-            message = "성공적으로 저장되었습니다!"
+        message = "성공적으로 저장되었습니다!" if html_data else "새 문서가 성공적으로 생성되었습니다."
+        # a new document or changed filters change the counts, an edit of the content doesn't
+        filters_changed = not html_data or any(html_data.get(field) != saved_html.get(field) for field in HTML_FILTER_FIELDS)
+        await _after_save(html_id, saved_html, filters_changed)
 
-        else:
-            # create new document
-            new_html_content["createdAt"] = datetime.datetime.now()
-            html_data_ref.set(new_html_content)
-            message = "새 문서가 성공적으로 생성되었습니다."
+        return JSONResponse(
+            content={"message": message, "success": True, "id": html_id, "revision": saved_html["revision"]},
+            status_code=200,
+        )
 
+    except Exception as e:
+        print(e)
         return JSONResponse(
-            content={"message": message, "success": True, "id": html_data_ref.id},
+            content={
+                "message": f"저장에 실패했습니다!: {str(e)}",
+                "success": False,
+            },
+            status_code=500,
+        )
+
+
+class HtmlPatchOp(BaseModel):
+    # replaces [start, end) of the base revision with text, offsets in UTF-16 code units like JS strings
+    start: int
+    end: int
+    text: str = ""
+
+
+class HtmlPatchModel(BaseModel):
+    access_token: str
+    id: str
+    base_revision: int
+    ops: List[HtmlPatchOp]
+    # sha256 of the content (utf-8) as the editor has it after the patch, a patch applied differently
+    # than in the editor is refused before anything is written
+    content_hash: str
+    title: str | None = None
+    carrier_type: str | None = None
+    selected_agent: str | None = None
+    policy_date_month: str | None = None
+    selected_mvnos: list | None = None
+
+
+@router.post("/save-html-patch")
+async def save_html_patch(data: HtmlPatchModel):
+    # autosave of large documents, only the edited ranges are sent and written to the revision history
+
+    try:
+        has_access, user_name = await check_role(data.access_token)
+
+        if not has_access:
+            return JSONResponse(content={"success": False, "message": "접근이 허용되지 않습니다!"}, status_code=200)
+
+        # metadata fields are only changed when sent
+        fields = {
+            field: value
+            for field, value in {
+                "title": data.title,
+                "carrierType": data.carrier_type,
+                "selectedAgent": data.selected_agent,
+                "policyDateMonth": data.policy_date_month,
+                "selectedMvnos": data.selected_mvnos,
+            }.items()
+            if value is not None
+        }
+
+        try:
+            saved_html = await run_db(
+                commit_patch,
+                database.transaction(),
+                data.id,
+                data.base_revision,
+                [op.model_dump() for op in data.ops],
+                fields,
+                user_name,
+                data.content_hash,
+            )
+        except PermissionError:
+            return JSONResponse(content={"success": False, "message": "업데이트 권한이 부여되지 않았습니다."}, status_code=200)
+        except LookupError:
+            return JSONResponse(content={"success": False, "message": "문서를 찾을 수 없습니다."}, status_code=404)
+        except StaleRevisionError as e:
+            # the editor reloads the document and retries on the latest revision
+            return JSONResponse(
+                content={"success": False, "message": "문서가 다른 곳에서 수정되었습니다.", "revision": e.revision},
+                status_code=409,
+            )
+        except ValueError as e:
+            return JSONResponse(content={"success": False, "message": f"잘못된 변경 내용입니다: {str(e)}"}, status_code=400)
+
+        await _after_save(data.id, saved_html, any(field in fields for field in HTML_FILTER_FIELDS))
+
+        return JSONResponse(
+            content={
+                "message": "성공적으로 저장되었습니다!",
+                "success": True,
+                "id": data.id,
+                "revision": saved_html["revision"],
+                "contentHash": saved_html["contentHash"],
+            },
             status_code=200,
         )
 
@@ -161,6 +337,35 @@ async def save_html_string(data: HtmlModel):
         )
 
 
+@router.post("/get-html-revision")
+async def get_html_revision(request: Request):
+    data = await request.json()
+    id = data.get("id", None)
+    revision = data.get("revision", None)
+
+    try:
+        if not id or not isinstance(revision, int):
+            return JSONResponse(content={"content": None, "message": "id and revision are required"}, status_code=400)
+
+        content = await run_db(load_revision, id, revision)
+        if content is None:
+            return JSONResponse(content={"content": None, "message": "Revision not found"}, status_code=400)
+
+        return FastJSONResponse(content={"id": id, "revision": revision, "content": content}, status_code=200)
+
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+async def _after_save(html_id: str, saved_html: dict, filters_changed: bool):
+    if filters_changed:
+        await clear_htmls_count()
+    await invalidate_html(html_id)
+
+    # the saved document is rendered and compressed now, so the next /get-html serves it ready made
+    precompress(html_id, html_cache.put(html_id, html_etag(html_id, saved_html), render_html(saved_html)))
+
+
 @router.post("/delete-html")
 async def delete_html(request: Request):
 
@@ -169,19 +374,22 @@ async def delete_html(request: Request):
         access_token = data.get("accessToken")
 
         id = data.get("id", None)
-        has_access, user_name = check_role(access_token)
+        has_access, user_name = await check_role(access_token)
 
         if not has_access:
             return JSONResponse(content={"success": False, "message": "접근이 허가되지 않았습니다"}, status_code=200)
 
         html_data_ref = database.collection("htmls").document(id)
-        html_data = html_data_ref.get().to_dict()
+        html_data = (await run_db(html_data_ref.get)).to_dict()
 
         if user_name != html_data.get("creator", None):
             return JSONResponse(content={"success": False, "message": "삭제 권한이 부여되지 않았습니다."}, status_code=200)
 
         doc_ref = database.collection("htmls").document(id)
-        doc_ref.delete()
+        await run_db(doc_ref.delete)
+        await run_db(delete_revisions, id)
+        await clear_htmls_count()
+        await invalidate_html(id)
 
         return JSONResponse(content={"success": True, "message": "내용이 삭제되었습니다"}, status_code=200)
 
@@ -196,27 +404,14 @@ async def delete_html(request: Request):
 
 
 @router.post("/upload-html-image")
-async def upload_html_image(file: UploadFile = File(..., max_size=1024 * 1024 * 10)):
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="File has no filename")
+async def upload_html_image(file: UploadFile = File(..., max_size=UPLOAD_MAX_SIZE)):
     try:
-        # generates a unique filename
-        filename = f"{uuid.uuid4()}.{file.filename.split('.')[-1]}"
-
-        # creates a blob in the bucket and upload the file data
-        blob = bucket.blob("html_images/" + filename)
-
-        # reads the file content
-        content = await file.read()
-
-        # uploads the file to Firebase Storage
-        blob.upload_from_string(content, content_type=file.content_type)
-
-        # makes the blob publicly accessible (optional)
-        blob.make_public()
-
-        return JSONResponse(content={"filename": filename, "path": blob.public_url}, status_code=200)
+        # streams the file to storage under its content hash, identical images share one blob
+        uploaded = await store_upload(file, "html_images/")
+        return JSONResponse(content=uploaded, status_code=200)
 
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -228,27 +423,63 @@ async def get_html(request: Request):
     # print(id)
 
     try:
-        doc_ref = database.collection("htmls").document(id).get()
-
-        if doc_ref:
+        # cached body answers without firestore, a matching If-None-Match without a body at all
+        cached = html_cache.get(id) if id else None
+        if cached is not None:
+            return _html_response(request, id, cached)
+
+        html_cache.begin_load(id)
+        try:
+            doc_ref = await run_db(database.collection("htmls").document(id).get)
+        except Exception:
+            html_cache.cancel_load(id)
+            raise
+
+        if doc_ref.exists:
             html = doc_ref.to_dict()
-            # html["updatedAt"] = html["updatedAt"].strftime("%Y-%m-%d %H:%M")
-            html["updatedAt"] = format_date(html.get("updatedAt"))
-            # html["createdAt"] = html["createdAt"].strftime("%Y-%m-%d %H:%M")
-            html["createdAt"] = format_date(html.get("createdAt"))
-            html["policyDateMonth"] = html.get("policyDateMonth")
-            return JSONResponse(content={"html": html}, status_code=200)
+            return _html_response(request, id, html_cache.fill(id, html_etag(id, html), render_html(html)))
 
         else:
+            html_cache.cancel_load(id)
             return JSONResponse(content={"html": None, "message": "Content not found"}, status_code=400)
 
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
-def check_role(access_token: str):
+def render_html(html: dict) -> bytes:
+    # /get-html body of a document
+    html = dict(html)
+    # html["updatedAt"] = html["updatedAt"].strftime("%Y-%m-%d %H:%M")
+    html["updatedAt"] = format_date(html.get("updatedAt"))
+    # html["createdAt"] = html["createdAt"].strftime("%Y-%m-%d %H:%M")
+    html["createdAt"] = format_date(html.get("createdAt"))
+    html["policyDateMonth"] = html.get("policyDateMonth")
+    # base_revision of the editor's next /save-html-patch
+    html["revision"] = html.get("revision", 0)
+    return dumps_bytes({"html": html})
+
+
+def _html_response(request: Request, html_id: str, cached: CachedHtml) -> Response:
+    # no-cache, clients keep the body but revalidate with the ETag every time
+    headers = {"ETag": cached.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    if etag_matches(request.headers.get("if-none-match"), cached.etag):
+        html_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+
+    # precompressed variant when there is one, otherwise identity while it is made in the background
+    encoding = choose_encoding(request.headers.get("accept-encoding"), cached.variants)
+    if encoding is None:
+        precompress(html_id, cached)
+        return Response(content=cached.body, media_type="application/json", headers=headers)
+
+    return Response(content=cached.variants[encoding], media_type="application/json", headers={**headers, "Content-Encoding": encoding})
+
+
+async def check_role(access_token: str):
     try:
-        user_info = get_user_info(access_token)
+        user_info = await get_user_info(access_token)
         user_name = user_info.get("username", None)
 
         roles = user_info.get("roles", [])
@@ -0,0 +1,248 @@
+import bisect
+import datetime
+import hashlib
+from typing import List, Optional
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from firebase_instance import database
+
+
+# a revision stores only its ops, every HTML_SNAPSHOT_EVERY revisions the full content is stored again
+HTML_SNAPSHOT_EVERY = 20
+HTML_PATCH_MAX_OPS = 1000
+# revisions older than the oldest of the last HTML_KEEP_SNAPSHOTS snapshots are deleted
+HTML_KEEP_SNAPSHOTS = 5
+
+
+class StaleRevisionError(Exception):
+    """The patch was made against an older revision than the stored one"""
+
+    def __init__(self, revision: int):
+        super().__init__(f"revision {revision} is the latest")
+        self.revision = revision
+
+
+def content_fields(content: str) -> dict:
+    # stored next to the content so listings can show size / detect changes without reading it
+    encoded = content.encode("utf-8")
+    return {"contentSize": len(encoded), "contentHash": hashlib.sha256(encoded).hexdigest()}
+
+
+def _utf16_converter(content: str):
+    # maps a utf-16 offset of content (what the browser editor counts) to a python string index.
+    # characters outside the BMP are 2 units there and 1 here, offsets between the two are refused
+    pair_ends = []
+    units = 0
+    for char in content:
+        units += 2 if ord(char) > 0xFFFF else 1
+        if ord(char) > 0xFFFF:
+            pair_ends.append(units)
+
+    def to_index(offset: int) -> int:
+        if offset < 0 or offset > units:
+            raise ValueError("Invalid patch operation")
+        before = bisect.bisect_right(pair_ends, offset)
+        if before < len(pair_ends) and pair_ends[before] - 1 == offset:
+            raise ValueError("Patch offset splits a character")
+        return offset - before
+
+    return to_index
+
+
+def apply_patch(content: str, ops: List[dict]) -> str:
+    """Applies splice ops {start, end, text} to content, raises ValueError for an invalid patch.
+
+    Offsets are UTF-16 code units of the base content, as JavaScript strings count them, ops must be
+    sorted and not overlap.
+    """
+    if len(ops) > HTML_PATCH_MAX_OPS:
+        raise ValueError("Too many patch operations")
+
+    # mostly BMP only (korean included), then offsets and indexes are the same
+    to_index = _utf16_converter(content) if any(ord(char) > 0xFFFF for char in content) else None
+
+    parts = []
+    position = 0
+    for op in ops:
+        start, end = op["start"], op["end"]
+        if to_index is not None:
+            start, end = to_index(start), to_index(end)
+        if start < position or end < start or end > len(content):
+            raise ValueError("Invalid patch operation")
+
+        parts.append(content[position:start])
+        parts.append(op.get("text") or "")
+        position = end
+
+    parts.append(content[position:])
+    return "".join(parts)
+
+
+def _common_prefix(a: str, b: str) -> int:
+    # binary search on slice comparisons, a character loop is slow for large documents
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def diff_ops(old: str, new: str) -> List[dict]:
+    """One splice op turning old into new (none when they are equal), in the offsets apply_patch takes"""
+    if old == new:
+        return []
+
+    prefix = _common_prefix(old, new)
+    suffix = _common_prefix(old[prefix:][::-1], new[prefix:][::-1])
+
+    def units(index: int) -> int:
+        return len(old[:index].encode("utf-16-le")) // 2
+
+    return [{"start": units(prefix), "end": units(len(old) - suffix), "text": new[prefix:len(new) - suffix]}]
+
+
+def revisions_ref(html_id: str):
+    return database.collection("htmls").document(html_id).collection("revisions")
+
+
+def _revision_id(revision: int) -> str:
+    # zero padded so document ids sort like revisions
+    return f"{revision:08d}"
+
+
+def _write_revision(transaction, html_id: str, html: dict, revision: int, user_name: str, ops: Optional[List[dict]] = None):
+    # sets snapshotRevision / snapshotRevisions on html, the caller writes it in the same transaction
+    last_snapshot = html.get("snapshotRevision")
+    snapshot = ops is None or last_snapshot is None or revision - last_snapshot >= HTML_SNAPSHOT_EVERY
+
+    record = {
+        "revision": revision,
+        "creator": user_name,
+        "createdAt": datetime.datetime.now(),
+        "snapshot": snapshot,
+        "snapshotRevision": revision if snapshot else last_snapshot,
+        "contentHash": html["contentHash"],
+    }
+    if snapshot:
+        record["content"] = html["content"]
+    else:
+        record["ops"] = ops
+
+    transaction.set(revisions_ref(html_id).document(_revision_id(revision)), record)
+    html["snapshotRevision"] = record["snapshotRevision"]
+    if not snapshot:
+        return
+
+    # revision ids are known, so old ones are deleted here without a query
+    snapshots = html.get("snapshotRevisions") or ([last_snapshot] if last_snapshot is not None else [])
+    snapshots = [*snapshots, revision]
+    if len(snapshots) > HTML_KEEP_SNAPSHOTS:
+        dropped, snapshots = snapshots[:-HTML_KEEP_SNAPSHOTS], snapshots[-HTML_KEEP_SNAPSHOTS:]
+        for old_revision in range(dropped[0], snapshots[0]):
+            transaction.delete(revisions_ref(html_id).document(_revision_id(old_revision)))
+    html["snapshotRevisions"] = snapshots
+
+
+@firestore.transactional
+def commit_save(transaction, html_id: str, new_html_content: dict, user_name: str) -> tuple[Optional[dict], dict]:
+    """Writes a full save as the next revision, returns (document before, document after).
+
+    Raises PermissionError when the document belongs to another user.
+    """
+    html_ref = database.collection("htmls").document(html_id)
+    html_data = html_ref.get(transaction=transaction).to_dict()
+
+    if html_data and user_name != html_data.get("creator", None):
+        raise PermissionError("not the creator")
+
+    revision = (html_data or {}).get("revision", 0) + 1
+    saved_html = {**(html_data or {}), **new_html_content, "revision": revision}
+    if not html_data:
+        saved_html["createdAt"] = datetime.datetime.now()
+
+    # stored as a diff against the content before, a snapshot every HTML_SNAPSHOT_EVERY revisions
+    ops = diff_ops(html_data["content"], saved_html["content"]) if html_data and html_data.get("content") is not None else None
+    if ops is not None and len(ops) == 1 and len(ops[0]["text"]) > len(saved_html["content"]) // 2:
+        # mostly rewritten, the content is cheaper to keep than the diff
+        ops = None
+    _write_revision(transaction, html_id, saved_html, revision, user_name, ops)
+    transaction.set(html_ref, saved_html)
+    return html_data, saved_html
+
+
+@firestore.transactional
+def commit_patch(transaction, html_id: str, base_revision: int, ops: List[dict], fields: dict, user_name: str, content_hash: str) -> dict:
+    """Applies a patch made against base_revision and writes it as the next revision, returns the saved document.
+
+    Raises LookupError for a missing document, PermissionError for another user's document,
+    StaleRevisionError when base_revision isn't the latest and ValueError for an invalid patch or
+    when the result doesn't match content_hash.
+    """
+    html_ref = database.collection("htmls").document(html_id)
+    html_data = html_ref.get(transaction=transaction).to_dict()
+
+    if not html_data:
+        raise LookupError("document not found")
+    if user_name != html_data.get("creator", None):
+        raise PermissionError("not the creator")
+
+    # documents saved before revisions existed are revision 0
+    current_revision = html_data.get("revision", 0)
+    if base_revision != current_revision:
+        raise StaleRevisionError(current_revision)
+
+    content = apply_patch(html_data.get("content") or "", ops)
+    patched_fields = content_fields(content)
+    if content_hash.lower() != patched_fields["contentHash"]:
+        raise ValueError("Patched content doesn't match content_hash")
+
+    revision = current_revision + 1
+    saved_html = {
+        **html_data,
+        **fields,
+        **patched_fields,
+        "content": content,
+        "creator": user_name,
+        "updatedAt": datetime.datetime.now(),
+        "revision": revision,
+    }
+    _write_revision(transaction, html_id, saved_html, revision, user_name, ops)
+
+    # update instead of set, the unchanged fields aren't sent again
+    transaction.update(html_ref, {key: value for key, value in saved_html.items() if key not in html_data or html_data[key] != value})
+    return saved_html
+
+
+def load_revision(html_id: str, revision: int) -> Optional[str]:
+    """Rebuilds the content of a revision from its snapshot and the deltas after it, None when it isn't stored"""
+    record_ref = revisions_ref(html_id).document(_revision_id(revision)).get()
+    if not record_ref.exists:
+        return None
+
+    snapshot_revision = record_ref.to_dict()["snapshotRevision"]
+    records = (
+        revisions_ref(html_id)
+        .where(filter=FieldFilter("revision", ">=", snapshot_revision))
+        .where(filter=FieldFilter("revision", "<=", revision))
+        .order_by("revision")
+        .get()
+    )
+
+    content = None
+    for record in (record_ref.to_dict() for record_ref in records):
+        content = record["content"] if record["snapshot"] else apply_patch(content, record["ops"])
+    return content
+
+
+def delete_revisions(html_id: str):
+    # firestore doesn't delete subcollections with their document
+    batch = database.batch()
+    for count, record_ref in enumerate(revisions_ref(html_id).list_documents(), start=1):
+        batch.delete(record_ref)
+        if count % 500 == 0:
+            batch.commit()
+            batch = database.batch()
+    batch.commit()
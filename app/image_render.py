@@ -0,0 +1,35 @@
+import io
+from typing import Dict
+
+# Pillow is optional, without it uploads are stored without variants.
+# runs in pool workers, so nothing here may import firebase_instance
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+
+# variant name -> (max width/height, webp quality)
+IMAGE_VARIANTS = {
+    "thumbnail": (320, 70),
+    "display": (1600, 80),
+}
+
+
+def render_variants(data: bytes) -> Dict[str, bytes]:
+    # runs in a worker process, decoding and encoding images is cpu bound
+    image = Image.open(io.BytesIO(data))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+
+    variants = {}
+    for name, (max_size, quality) in IMAGE_VARIANTS.items():
+        variant = image.copy()
+        variant.thumbnail((max_size, max_size))
+
+        output = io.BytesIO()
+        variant.save(output, format="WEBP", quality=quality, method=4)
+        variants[name] = output.getvalue()
+
+    return variants
@@ -0,0 +1,77 @@
+import asyncio
+from typing import Dict, Set
+from firebase_instance import bucket, run_storage
+from app.image_render import IMAGE_VARIANTS, Image, render_variants
+from app.process_pool import ProcessPool
+
+
+IMAGE_WORKERS = 2
+IMAGE_TIMEOUT = 30
+
+image_pool = ProcessPool(max_workers=IMAGE_WORKERS)
+
+# digests whose variants are being made, a re-upload meanwhile doesn't start another
+_rendering: Set[str] = set()
+_variant_tasks: Set[asyncio.Task] = set()
+
+
+def shutdown_image_pool():
+    for task in _variant_tasks:
+        task.cancel()
+    image_pool.shutdown()
+
+
+def variant_blob(prefix: str, digest: str, name: str):
+    return bucket.blob(f"{prefix}{digest}_{name}.webp")
+
+
+def stored_variant_urls(original_blob) -> Dict[str, str]:
+    # variant urls are kept in the original blob's metadata once they are all stored
+    metadata = original_blob.metadata or {}
+    if all(f"{name}_url" in metadata for name in IMAGE_VARIANTS):
+        return {name: metadata[f"{name}_url"] for name in IMAGE_VARIANTS}
+    return {}
+
+
+def variant_urls(prefix: str, digest: str) -> Dict[str, str]:
+    # public urls the variants get, known before they are stored
+    return {name: variant_blob(prefix, digest, name).public_url for name in IMAGE_VARIANTS}
+
+
+def create_image_variants(data: bytes, prefix: str, digest: str, original_blob) -> bool:
+    """Makes thumbnail / display variants of an uploaded image in the background, False when it can't.
+
+    They are stored next to the original and their urls are added to its metadata.
+    """
+    if Image is None:
+        return False
+    if digest in _rendering:
+        return True
+
+    _rendering.add(digest)
+    task = asyncio.create_task(_store_variants(data, prefix, digest, original_blob))
+    _variant_tasks.add(task)
+    task.add_done_callback(_variant_tasks.discard)
+    return True
+
+
+async def _store_variants(data: bytes, prefix: str, digest: str, original_blob):
+    try:
+        rendered = await image_pool.run(render_variants, data, timeout=IMAGE_TIMEOUT)
+
+        urls = {}
+        for name in IMAGE_VARIANTS:
+            blob = variant_blob(prefix, digest, name)
+            await run_storage(blob.upload_from_string, rendered[name], content_type="image/webp")
+            await run_storage(blob.make_public)
+            urls[name] = blob.public_url
+
+        original_blob.metadata = {**(original_blob.metadata or {}), **{f"{name}_url": url for name, url in urls.items()}}
+        await run_storage(original_blob.patch)
+
+    except Exception as e:
+        # not an image Pillow can read, the original is still usable
+        print(f"Error creating image variants: {e}")
+
+    finally:
+        _rendering.discard(digest)
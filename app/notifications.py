@@ -0,0 +1,253 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from firebase_admin import exceptions, firestore, messaging
+from firebase_instance import database, run_db
+from websocket_manager import manager
+from app.cache import TTLCache
+
+
+# FCM accepts at most 500 tokens per multicast
+FCM_MAX_TOKENS = 500
+
+NOTIFICATION_WORKERS = 4
+NOTIFICATION_QUEUE_SIZE = 10000
+NOTIFICATION_MAX_RETRIES = 3
+NOTIFICATION_RETRY_DELAY = 1
+
+# chat text is cut to this length, FCM rejects payloads over 4KB
+NOTIFICATION_BODY_MAX_LENGTH = 200
+
+# messages to one recipient in one room within this window are sent as one notification
+NOTIFICATION_COALESCE_WINDOW = 3
+
+# fcm_tokens of users/{identifier}, kept write-through so fan-out and reconnects don't read the doc
+FCM_TOKENS_CACHE_SIZE = 10000
+FCM_TOKENS_TTL = 600
+
+fcm_tokens_cache = TTLCache(maxsize=FCM_TOKENS_CACHE_SIZE, ttl=FCM_TOKENS_TTL)
+
+
+async def get_fcm_tokens(identifier: str) -> List[str]:
+    fcm_tokens = fcm_tokens_cache.get(identifier)
+    if fcm_tokens is not None:
+        return fcm_tokens
+
+    user_ref = await run_db(database.collection("users").document(identifier).get)
+    fcm_tokens = (user_ref.to_dict() or {}).get("fcm_tokens", []) if user_ref.exists else []
+    fcm_tokens_cache.set(identifier, fcm_tokens)
+    return fcm_tokens
+
+
+async def register_fcm_token(identifier: str, fcm_token: str):
+    # reconnecting devices send the same token again, that costs no write
+    fcm_tokens = await get_fcm_tokens(identifier)
+    if fcm_token in fcm_tokens:
+        return
+
+    await run_db(database.collection("users").document(identifier).set, {"fcm_tokens": firestore.ArrayUnion([fcm_token])}, merge=True)
+    fcm_tokens_cache.set(identifier, fcm_tokens + [fcm_token])
+    await manager.broadcast_event("fcm_tokens_changed", {"identifier": identifier, "node": manager.node_id})
+
+
+async def remove_fcm_tokens(identifier: str, invalid_tokens: List[str]):
+    await run_db(database.collection("users").document(identifier).update, {"fcm_tokens": firestore.ArrayRemove(invalid_tokens)})
+
+    fcm_tokens = fcm_tokens_cache.get(identifier)
+    if fcm_tokens is not None:
+        fcm_tokens_cache.set(identifier, [token for token in fcm_tokens if token not in invalid_tokens])
+    await manager.broadcast_event("fcm_tokens_changed", {"identifier": identifier, "node": manager.node_id})
+
+
+async def _on_fcm_tokens_changed(data: dict):
+    # other workers drop their copy and read it again on next use
+    if data.get("node") != manager.node_id:
+        fcm_tokens_cache.pop(data["identifier"])
+
+
+manager.on_event("fcm_tokens_changed", _on_fcm_tokens_changed)
+
+
+# per token errors that mean the token will never work again. InvalidArgumentError is left out,
+# FCM also returns it for a bad message (e.g. too large) and the tokens are fine then
+INVALID_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
+# errors worth another attempt
+RETRYABLE_ERRORS = (exceptions.UnavailableError, exceptions.InternalError, exceptions.ResourceExhaustedError, exceptions.DeadlineExceededError)
+
+# send_multicast was replaced by send_each_for_multicast in newer firebase_admin
+_send_multicast = getattr(messaging, "send_each_for_multicast", None) or messaging.send_multicast
+
+
+class NotificationDispatcher:
+    """Sends chat push notifications from a background queue.
+
+    Workers look up the receiver's FCM tokens (cached), send in chunks of 500 with retries, and remove
+    tokens FCM reports as invalid from users/{identifier}.fcm_tokens.
+    """
+
+    def __init__(self, workers: int = NOTIFICATION_WORKERS, max_size: int = NOTIFICATION_QUEUE_SIZE):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._tasks: List[asyncio.Task] = []
+        # (identifier, chat_room_id) -> [title, body, messages after the first] while its window is open
+        self._pending: Dict[Tuple[str, str], list] = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.pruned = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        self._pending.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self, identifier: str, title: str, body: str, chat_room_id: str):
+        # never waits, the websocket handler returns right away
+        if manager.is_in_room(identifier, chat_room_id):
+            self.skipped += 1
+            return
+
+        if len(body) > NOTIFICATION_BODY_MAX_LENGTH:
+            body = body[: NOTIFICATION_BODY_MAX_LENGTH - 1] + "…"
+
+        # messages after the first one in a window are held and sent together when it ends
+        key = (identifier, chat_room_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending[0], pending[1] = title, body
+            pending[2] += 1
+            self.coalesced += 1
+            return
+
+        # the first message goes out right away
+        self._pending[key] = [title, body, 0]
+        self._enqueue(identifier, title, body, chat_room_id)
+        asyncio.get_running_loop().call_later(NOTIFICATION_COALESCE_WINDOW, self._flush, key)
+
+    def _flush(self, key: Tuple[str, str]):
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+
+        identifier, chat_room_id = key
+        title, body, count = pending
+
+        # nothing followed the first message, or the recipient opened the room during the window
+        if count == 0 or manager.is_in_room(identifier, chat_room_id):
+            if count:
+                self.skipped += 1
+            return
+
+        if count > 1:
+            body = f"{count}개의 새 메시지가 있습니다"
+
+        self._enqueue(identifier, title, body, chat_room_id)
+
+    def _enqueue(self, identifier: str, title: str, body: str, chat_room_id: str):
+        try:
+            self.queue.put_nowait((identifier, title, body, chat_room_id))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"Notification queue full, dropped notification for {identifier}")
+
+    async def _worker(self):
+        while True:
+            identifier, title, body, chat_room_id = await self.queue.get()
+            try:
+                await self._deliver(identifier, title, body, chat_room_id)
+            except Exception as e:
+                print(f"Error sending notifications: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, identifier: str, title: str, body: str, chat_room_id: str):
+        fcm_tokens = await get_fcm_tokens(identifier)
+        if not fcm_tokens:
+            return
+
+        invalid_tokens = []
+        for start in range(0, len(fcm_tokens), FCM_MAX_TOKENS):
+            invalid_tokens += await self._send_chunk(fcm_tokens[start : start + FCM_MAX_TOKENS], title, body, chat_room_id)
+
+        if invalid_tokens:
+            await self._remove_tokens(identifier, invalid_tokens)
+
+    async def _remove_tokens(self, identifier: str, invalid_tokens: List[str]):
+        await remove_fcm_tokens(identifier, invalid_tokens)
+        self.pruned += len(invalid_tokens)
+
+    async def _send_chunk(self, tokens: List[str], title: str, body: str, chat_room_id: str) -> List[str]:
+        # returns tokens of the chunk that should be removed
+        invalid_tokens = []
+        delay = NOTIFICATION_RETRY_DELAY
+
+        for attempt in range(NOTIFICATION_MAX_RETRIES + 1):
+            response = await self._send(tokens, title, body, chat_room_id)
+
+            retry_tokens = []
+            if response is None:
+                retry_tokens = tokens
+            else:
+                for token, result in zip(tokens, response.responses):
+                    if result.success:
+                        self.sent += 1
+                    elif isinstance(result.exception, INVALID_TOKEN_ERRORS):
+                        invalid_tokens.append(token)
+                    elif isinstance(result.exception, RETRYABLE_ERRORS):
+                        retry_tokens.append(token)
+                    else:
+                        self.failed += 1
+
+            if not retry_tokens:
+                break
+            if attempt == NOTIFICATION_MAX_RETRIES:
+                self.failed += len(retry_tokens)
+                break
+
+            tokens = retry_tokens
+            await asyncio.sleep(delay)
+            delay *= 2
+
+        return invalid_tokens
+
+    async def _send(self, tokens: List[str], title: str, body: str, chat_room_id: str) -> Optional[messaging.BatchResponse]:
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(
+                title=title,
+                body=body,
+            ),
+            data={
+                "chat_room_id": chat_room_id,
+            },
+            tokens=tokens,
+        )
+
+        try:
+            # firebase_admin is blocking, runs in the default executor
+            return await asyncio.get_running_loop().run_in_executor(None, _send_multicast, message)
+        except RETRYABLE_ERRORS as e:
+            print(f"Error sending messages, retrying: {e}")
+            return None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "pending": len(self._pending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "pruned_tokens": self.pruned,
+            "coalesced": self.coalesced,
+            "skipped_in_room": self.skipped,
+        }
+
+
+notification_dispatcher = NotificationDispatcher()
@@ -2,8 +2,11 @@ import sys
 from typing import Optional
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field, field_validator
-from firebase_instance import database
-from app.utils import format_date, get_user_info
+from firebase_instance import database, run_db
+from app.cache import TTLCache
+from app.fast_json import FastJSONResponse
+from app.utils import decode_page_token, encode_page_token, format_date, get_user_info, page_cursor
+from websocket_manager import manager
 from google.cloud.firestore_v1.base_query import FieldFilter
 from firebase_admin import firestore
 from datetime import datetime
@@ -13,6 +16,24 @@ router = APIRouter()
 
 statuses = ["confirmed", "shipped", "delivered", "failed"]
 
+# total_count of /get-orders per username (None for admins), cleared when an order is created or deleted
+ORDERS_COUNT_TTL = 300
+orders_count_cache = TTLCache(maxsize=1000, ttl=ORDERS_COUNT_TTL)
+
+
+async def clear_orders_count():
+    # every worker keeps its own counts
+    orders_count_cache.clear()
+    await manager.broadcast_event("orders_count_changed", {"node": manager.node_id})
+
+
+async def _on_orders_count_changed(data: dict):
+    if data.get("node") != manager.node_id:
+        orders_count_cache.clear()
+
+
+manager.on_event("orders_count_changed", _on_orders_count_changed)
+
 
 class OrderItem(BaseModel):
     agent_code: str = Field(min_length=1)
@@ -48,7 +69,7 @@ class UsimOrderModel(BaseModel):
 async def create_or_update_order(data: UsimOrderModel):
     try:
         # userinfo
-        user_info = get_user_info(data.access_token)
+        user_info = await get_user_info(data.access_token)
         current_time = datetime.now()
 
         # determins if this is an update or create operation
@@ -58,7 +79,7 @@ async def create_or_update_order(data: UsimOrderModel):
 
             # Get existing order reference
             order_ref = database.collection("usim_orders").document(data.order_id)
-            order_doc = order_ref.get()
+            order_doc = await run_db(order_ref.get)
 
             if not order_doc.exists:
                 raise HTTPException(status_code=404, detail={"message": "Order not found", "success": False})
@@ -98,7 +119,7 @@ async def create_or_update_order(data: UsimOrderModel):
 
         # delete existing items if udpate
         if is_update:
-            existing_items = database.collection("usim_order_items").where("usim_order_id", "==", data.order_id).stream()
+            existing_items = await run_db(database.collection("usim_order_items").where("usim_order_id", "==", data.order_id).get)
             for item in existing_items:
                 batch.delete(item.reference)
 
@@ -116,7 +137,11 @@ async def create_or_update_order(data: UsimOrderModel):
             batch.set(new_item_ref, item_data)
 
         # commits all changes
-        batch.commit()
+        await run_db(batch.commit)
+
+        # updates keep the owner, so only a new order changes the counts
+        if not is_update:
+            await clear_orders_count()
 
         return {"message": "주문이 성공적으로 처리되었습니다", "success": True, "id": order_ref.id, "action": "updated" if is_update else "created"}
 
@@ -131,6 +156,8 @@ class GetUsimOrdersModel(BaseModel):
     access_token: str
     page_number: Optional[int] = 1
     per_page: Optional[int] = 100
+    # next_page_token of the previous response, page_number is only used when this is empty
+    page_token: Optional[str] = None
 
 
 @router.post("/get-orders", response_model=dict)
@@ -138,7 +165,7 @@ async def get_orders(data: GetUsimOrdersModel):
     try:
 
         # Get user info with error handling
-        user_info = get_user_info(data.access_token)
+        user_info = await get_user_info(data.access_token)
         username = user_info.get("username")
 
         is_retailer = user_info["is_retailer"]
@@ -154,9 +181,29 @@ async def get_orders(data: GetUsimOrdersModel):
         query = query.order_by("created_at", direction=firestore.Query.DESCENDING)
 
         # total count before applying limits
-        total_count = query.count().get()[0][0].value or 0
+        count_key = username if is_retailer else None
+        total_count = orders_count_cache.get(count_key)
+        if total_count is None:
+            total_count = (await run_db(query.count().get))[0][0].value or 0
+            orders_count_cache.set(count_key, total_count)
+
+        # keyset pagination when a page token is given, offset pagination as fallback
+        skipped = (data.page_number - 1) * data.per_page
+        if data.page_token:
+            try:
+                after_id, skipped, after_created_at = decode_page_token(data.page_token)
+            except ValueError:
+                raise HTTPException(status_code=400, detail={"message": "Invalid page token", "success": False})
+
+            after_ref = await page_cursor(database.collection("usim_orders"), after_id, "created_at", after_created_at)
+            if after_ref is None:
+                raise HTTPException(status_code=400, detail={"message": "Invalid page token", "success": False})
+            page_query = query.start_after(after_ref)
+        else:
+            page_query = query.offset(skipped)
+
         try:
-            usim_orders_ref = query.offset((data.page_number - 1) * data.per_page).limit(data.per_page).get()
+            usim_orders_ref = await run_db(page_query.limit(data.per_page).get)
         except Exception as e:
             raise HTTPException(status_code=500, detail={"message": "Failed to fetch orders", "success": False})
 
@@ -168,7 +215,7 @@ async def get_orders(data: GetUsimOrdersModel):
         # batch query for order items
         order_items_map = {}
         if order_ids:
-            order_items_query = database.collection("usim_order_items").where(filter=FieldFilter("usim_order_id", "in", order_ids)).get()
+            order_items_query = await run_db(database.collection("usim_order_items").where(filter=FieldFilter("usim_order_id", "in", order_ids)).get)
 
             # group order items by order ID
             for item_ref in order_items_query:
@@ -186,6 +233,7 @@ async def get_orders(data: GetUsimOrdersModel):
                 order_data = order_ref.to_dict()
                 order_data["created_at"] = format_date(order_data.get("created_at"))
                 order_data["last_status_updated_at"] = format_date(order_data.get("last_status_updated_at"))
+                order_data["last_updated_at"] = format_date(order_data.get("last_updated_at"))
                 order_data["order_items"] = order_items_map.get(order_ref.id, [])
                 usim_orders.append(order_data)
                 order_data["order_id"] = order_ref.id
@@ -193,12 +241,17 @@ async def get_orders(data: GetUsimOrdersModel):
             except Exception as e:
                 continue  # skips malformed orders instead of failing completely
 
-        return {
-            "message": "Data sent successfully",
-            "success": True,
-            "usim_orders": usim_orders,
-            "total_count": total_count,
-        }
+        return FastJSONResponse(
+            content={
+                "message": "Data sent successfully",
+                "success": True,
+                "usim_orders": usim_orders,
+                "total_count": total_count,
+                "next_page_token": (
+                    encode_page_token(usim_orders_ref[-1].id, skipped + len(usim_orders_ref), usim_orders_ref[-1].get("created_at")) if len(usim_orders_ref) == data.per_page else None
+                ),
+            }
+        )
 
     except HTTPException as http_error:
         raise http_error
@@ -219,10 +272,10 @@ async def get_order(data: OrderRequest):
     try:
 
         # user info
-        user_info = get_user_info(data.access_token)
+        user_info = await get_user_info(data.access_token)
         order_ref = database.collection("usim_orders").document(data.order_id)
         # print(order_ref.get().to_dict())
-        order = order_ref.get().to_dict()
+        order = (await run_db(order_ref.get)).to_dict()
 
         is_retailer = user_info["is_retailer"]
 
@@ -233,7 +286,7 @@ async def get_order(data: OrderRequest):
         order["last_status_updated_at"] = format_date(order.get("last_status_updated_at"))
         order["created_at"] = format_date(order.get("created_at"))
 
-        order_items_ref = database.collection("usim_order_items").where(filter=FieldFilter("usim_order_id", "==", order_ref.id)).get()
+        order_items_ref = await run_db(database.collection("usim_order_items").where(filter=FieldFilter("usim_order_id", "==", order_ref.id)).get)
 
         order_items = []
         for order_item_ref in order_items_ref:
@@ -254,10 +307,10 @@ async def get_order(data: OrderRequest):
 async def delete_order(data: OrderRequest):
     try:
         # user info
-        user_info = get_user_info(data.access_token)
+        user_info = await get_user_info(data.access_token)
         order_ref = database.collection("usim_orders").document(data.order_id)
 
-        order = order_ref.get().to_dict()
+        order = (await run_db(order_ref.get)).to_dict()
         if not order:
             raise HTTPException(status_code=404, detail={"message": "Order not found", "success": False})
 
@@ -265,7 +318,7 @@ async def delete_order(data: OrderRequest):
             raise HTTPException(status_code=500, detail={"message": "이 주문을 삭제할 권한이 없습니다.", "success": False})
 
         # get all order items
-        order_items_ref = database.collection("usim_order_items").where(filter=FieldFilter("usim_order_id", "==", order_ref.id)).get()
+        order_items_ref = await run_db(database.collection("usim_order_items").where(filter=FieldFilter("usim_order_id", "==", order_ref.id)).get)
 
         # create a batch operation
         batch = database.batch()
@@ -278,7 +331,8 @@ async def delete_order(data: OrderRequest):
             batch.delete(order_item_ref.reference)
 
         # commit the batch
-        batch.commit()
+        await run_db(batch.commit)
+        await clear_orders_count()
 
         return {"message": "주문이 성공적으로 삭제되었습니다", "success": True, "order_id": data.order_id}
 
@@ -312,14 +366,14 @@ class StatusUpdateModel(BaseModel):
 async def get_statuses(data: StatusUpdateModel):
     try:
 
-        user_info = get_user_info(data.access_token)
+        user_info = await get_user_info(data.access_token)
         is_retailer = user_info["is_retailer"]
         if is_retailer:
             raise HTTPException(status_code=500, detail={"message": "이 주문을 수정할 권한이 없습니다.", "success": False})
 
         # Get existing order reference
         order_ref = database.collection("usim_orders").document(data.order_id)
-        order_doc = order_ref.get()
+        order_doc = await run_db(order_ref.get)
 
         if not order_doc.exists:
             raise HTTPException(status_code=404, detail={"message": "Order not found", "success": False})
@@ -327,12 +381,13 @@ async def get_statuses(data: StatusUpdateModel):
         if data.new_status not in statuses:
             raise HTTPException(status_code=404, detail={"message": "Invalid status", "success": False})
 
-        order_ref.update(
+        await run_db(
+            order_ref.update,
             {
                 "status": data.new_status,
                 "sender_comment": data.sender_comment,
                 "last_status_updated_at": datetime.now(),
-            }
+            },
         )
         return {"message": "주문이 성공적으로 삭제되었습니다", "success": True}
 
@@ -0,0 +1,40 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+
+# what the forkserver imports once, every worker is forked from it with these already loaded.
+# the default preload is __main__, which would start the whole app (firebase included) there
+POOL_MODULES = ["app.image_render", "app.compression"]
+
+
+class ProcessPool:
+    """Lazily started process pool for cpu bound work (image rendering, compression).
+
+    Workers start from a forkserver, forking this process would copy the running grpc / firestore
+    threads' locks into the children and can hang them. Functions run here must live in POOL_MODULES,
+    which don't import firebase_instance. main.py starts the server through `python -m uvicorn` so
+    the workers don't re-run it as their __main__ either.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            context = multiprocessing.get_context("forkserver")
+            # only applies before the forkserver starts, i.e. when the first pool is created
+            context.set_forkserver_preload(POOL_MODULES)
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._executor
+
+    async def run(self, func, *args, timeout: float):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self._get_executor(), func, *args), timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from typing import Dict, Optional
+from websocket_manager import manager
+
+
+# signature requests waiting for /save-sign, so waiting clients cost no firestore reads
+SIGN_PENDING_TTL = 60 * 60
+SIGN_WAIT_TIMEOUT = 25
+SIGN_WAIT_MAX_TIMEOUT = 55
+
+
+class _PendingSign:
+    def __init__(self, partner_code: Optional[str]):
+        self.partner_code = partner_code
+        self.completed = asyncio.Event()
+        self.data: Optional[dict] = None  # sign_data / seal_data when completed on this worker
+        self.expires_at = time.monotonic() + SIGN_PENDING_TTL
+
+
+class SignRegistry:
+    """In-memory registry of pending e-signature keys.
+
+    /save-sign completes a key on every worker through the backplane, the worker that received the
+    signature hands its data to local waiters directly, others read the doc once.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, _PendingSign] = {}
+
+    def register(self, key: str, partner_code: Optional[str] = None) -> _PendingSign:
+        self._sweep()
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = _PendingSign(partner_code)
+        return pending
+
+    def is_pending(self, key: str) -> bool:
+        return key in self._pending
+
+    async def wait(self, key: str, timeout: float) -> Optional[_PendingSign]:
+        # returns the completed entry, or None on timeout
+        pending = self.register(key)
+        try:
+            await asyncio.wait_for(pending.completed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return pending
+
+    async def complete(self, key: str, sign_data, seal_data):
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.data = {"sign_data": sign_data, "seal_data": seal_data}
+            pending.completed.set()
+
+        # signatures are large, other workers only get the key
+        await manager.broadcast_event("sign_completed", {"key": key, "node": manager.node_id})
+
+    def mark_completed(self, key: str):
+        # completed on another worker, waiters read the doc themselves
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.completed.set()
+
+    def discard(self, key: str):
+        self._pending.pop(key, None)
+
+    def _sweep(self):
+        now = time.monotonic()
+        for key in [key for key, pending in self._pending.items() if pending.expires_at <= now]:
+            del self._pending[key]
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending)}
+
+
+sign_registry = SignRegistry()
+
+
+async def _on_sign_completed(data: dict):
+    if data.get("node") == manager.node_id:
+        return
+
+    sign_registry.mark_completed(data["key"])
+
+
+manager.on_event("sign_completed", _on_sign_completed)
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+import httpx
+from sensitive import ALI_GO_API_KEY
+
+
+ALIGO_SEND_URL = "https://apis.aligo.in/send/"  # 요청을 던지는 URL, 현재는 문자보내기
+ALIGO_USER_ID = "simpass"  # 알리고 사이트 아이디
+ALIGO_SENDER = "0221083121"  # 발신번호
+
+# aligo takes up to 1000 comma separated receivers per request
+ALIGO_MAX_RECEIVERS = 1000
+
+# requests queued within this window with the same title and message go out as one request
+SMS_BATCH_WINDOW = 0.5
+# max aligo requests per second
+SMS_RATE_LIMIT = 5
+SMS_QUEUE_SIZE = 10000
+SMS_TIMEOUT = 10.0
+
+
+class SmsDispatcher:
+    """Sends LMS through aligo from a background queue with one pooled HTTP client.
+
+    Receivers of identical messages are merged into aligo's comma separated receiver list.
+    """
+
+    def __init__(self, max_size: int = SMS_QUEUE_SIZE):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_request = 0.0
+
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=SMS_TIMEOUT, limits=httpx.Limits(max_connections=5, max_keepalive_connections=5))
+        self._task = asyncio.create_task(self._worker())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def full(self) -> bool:
+        return self.queue.full()
+
+    def send(self, receiver_phone_number: str, title: str, message: str):
+        # raises asyncio.QueueFull when the backlog is too large to accept more
+        self.queue.put_nowait((receiver_phone_number, title, message))
+
+    async def _worker(self):
+        while True:
+            items = [await self.queue.get()]
+
+            # collects whatever else arrives within the window
+            deadline = time.monotonic() + SMS_BATCH_WINDOW
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # only identical texts merge, /send-single-sms messages carry their own sign link and never do
+            groups: Dict[Tuple[str, str], List[str]] = {}
+            for receiver_phone_number, title, message in items:
+                groups.setdefault((title, message), []).append(receiver_phone_number)
+
+            for (title, message), receivers in groups.items():
+                receivers = list(dict.fromkeys(receivers))
+                for start in range(0, len(receivers), ALIGO_MAX_RECEIVERS):
+                    await self._post(receivers[start : start + ALIGO_MAX_RECEIVERS], title, message)
+
+            for _ in items:
+                self.queue.task_done()
+
+    async def _post(self, receivers: List[str], title: str, message: str):
+        # simple rate limit, keeps at least 1 / SMS_RATE_LIMIT seconds between requests
+        wait = self._last_request + 1 / SMS_RATE_LIMIT - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_request = time.monotonic()
+
+        # API key, userid, sender, receiver, msg
+        # API키, 알리고 사이트 아이디, 발신번호, 수신번호, 문자내용
+        sms_data = {
+            "key": ALI_GO_API_KEY,  # api key
+            "userid": ALIGO_USER_ID,
+            "sender": ALIGO_SENDER,
+            "receiver": ",".join(receivers),  # 수신번호 (,활용하여 1000명까지 추가 가능)
+            "msg": message,  # 문자 내용
+            "msg_type": "LMS",  # 메세지 타입 (SMS, LMS)
+            "title": title,  # 메세지 제목 (장문에 적용)
+        }
+
+        self.requests += 1
+        try:
+            response = await self._client.post(ALIGO_SEND_URL, data=sms_data)
+            result = response.json()
+            print(result)
+
+            # aligo answers result_code 1 on success, negative codes on failure
+            if str(result.get("result_code")) == "1":
+                self.sent += len(receivers)
+            else:
+                self.failed += len(receivers)
+        except Exception as e:
+            self.failed += len(receivers)
+            print(f"Error sending sms: {e}")
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "requests": self.requests, "sent": self.sent, "failed": self.failed}
+
+
+sms_dispatcher = SmsDispatcher()
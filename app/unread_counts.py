@@ -0,0 +1,144 @@
+import asyncio
+from typing import Set
+from firebase_instance import database, run_db
+from google.cloud.firestore_v1.base_query import FieldFilter
+from firebase_admin import firestore
+from app.cache import LoadGuard, TTLCache
+from websocket_manager import manager
+
+
+# per identifier (agent code or partner code) unread total, kept next to the per room counters
+# unread_totals/{identifier} = {"agent_unread_count": int, "partner_unread_count": int, "<field>_synced": True}
+UNREAD_TOTALS_COLLECTION = "unread_totals"
+
+# totals are also kept in memory and adjusted on every local write.
+# ttl only bounds how long a change made by another worker can go unseen
+UNREAD_TOTALS_CACHE_SIZE = 10000
+UNREAD_TOTALS_TTL = 60
+
+unread_totals_cache = TTLCache(maxsize=UNREAD_TOTALS_CACHE_SIZE, ttl=UNREAD_TOTALS_TTL)
+# totals being read from firestore, a delta meanwhile keeps the read value out of the cache
+unread_totals_loads = LoadGuard()
+
+_push_tasks: Set[asyncio.Task] = set()
+
+
+def unread_field(is_retailer: bool) -> str:
+    return "partner_unread_count" if is_retailer else "agent_unread_count"
+
+
+def total_ref(identifier: str):
+    return database.collection(UNREAD_TOTALS_COLLECTION).document(identifier)
+
+
+async def get_total_unread_count(is_retailer: bool, identifier: str) -> int:
+    # return fll chat rooms total_unread_counts of given identifier (agent code or partner code)
+    field = unread_field(is_retailer)
+
+    total = unread_totals_cache.get((field, identifier))
+    if total is not None:
+        return total
+
+    unread_totals_loads.begin_load((field, identifier))
+    try:
+        total_doc = (await run_db(total_ref(identifier).get)).to_dict() or {}
+
+        if total_doc.get(f"{field}_synced"):
+            total = max(total_doc.get(field, 0), 0)
+        else:
+            # first time for this identifier, counts all rooms once and stores the total
+            total = await run_db(_sync_total, database.transaction(), is_retailer, identifier)
+    except Exception:
+        unread_totals_loads.cancel_load((field, identifier))
+        raise
+
+    if unread_totals_loads.finish_load((field, identifier)):
+        unread_totals_cache.set((field, identifier), total)
+    return total
+
+
+@firestore.transactional
+def _sync_total(transaction, is_retailer: bool, identifier: str) -> int:
+    search_field = "partner_code" if is_retailer else "agent_code"
+    field = unread_field(is_retailer)
+
+    # room counters and the total are always written together, so the rooms read in this
+    # transaction are consistent with the total being overwritten
+    rooms_query = database.collection("chat_rooms").where(filter=FieldFilter(search_field, "==", identifier))
+    total = sum(room_ref.to_dict().get(field, 0) for room_ref in transaction.get(rooms_query))
+
+    transaction.set(total_ref(identifier), {field: total, f"{field}_synced": True}, merge=True)
+    return total
+
+
+def increment_unread(batch, room_ref, is_retailer: bool, identifier: str, amount: int = 1):
+    """Adds room and total counter increments of the given side to a batch or transaction"""
+    field = unread_field(is_retailer)
+    batch.update(room_ref, {field: firestore.Increment(amount)})
+    batch.set(total_ref(identifier), {field: firestore.Increment(amount)}, merge=True)
+
+
+async def apply_local_delta(is_retailer: bool, identifier: str, amount: int, push_total: bool = False):
+    # keeps the in-memory totals of every worker in step with a committed write,
+    # with push_total the identifier's sockets also get the new total_count
+    await manager.broadcast_event("unread_delta", {"is_retailer": is_retailer, "identifier": identifier, "amount": amount, "push_total": push_total})
+
+
+async def _on_unread_delta(data: dict):
+    key = (unread_field(data["is_retailer"]), data["identifier"])
+    total = unread_totals_cache.get(key)
+    if total is None:
+        # a read in flight may predate this write
+        unread_totals_loads.invalidate_load(key)
+
+        # expired on the worker holding the sockets, it is loaded again there in the background.
+        # the write is committed by now, so the read includes it
+        if data.get("push_total") and data["identifier"] in manager.active_connections:
+            task = asyncio.create_task(_push_loaded_total(data["is_retailer"], data["identifier"]))
+            _push_tasks.add(task)
+            task.add_done_callback(_push_tasks.discard)
+        return
+
+    total = max(total + data["amount"], 0)
+    unread_totals_cache.set(key, total)
+
+    # pushed from memory by the workers holding the sockets, nothing is read on the message path
+    if data.get("push_total"):
+        manager.send_json_local({"type": "total_count", "total_unread_count": total}, [data["identifier"]])
+
+
+async def _push_loaded_total(is_retailer: bool, identifier: str):
+    try:
+        total = await get_total_unread_count(is_retailer, identifier)
+        manager.send_json_local({"type": "total_count", "total_unread_count": total}, [identifier])
+    except Exception as e:
+        print(f"Error loading total unread count: {e}")
+
+
+manager.on_event("unread_delta", _on_unread_delta)
+
+
+async def reset_room_unread_count(room_id: str, is_retailer: bool) -> dict:
+    """Sets the room counter of the given side to 0 and subtracts it from the total, returns the updated room"""
+    room, cleared = await run_db(_reset_room, database.transaction(), room_id, is_retailer)
+
+    identifier = room["partner_code"] if is_retailer else room["agent_code"]
+    await apply_local_delta(is_retailer, identifier, -cleared)
+    return room
+
+
+@firestore.transactional
+def _reset_room(transaction, room_id: str, is_retailer: bool) -> tuple[dict, int]:
+    field = unread_field(is_retailer)
+    room_ref = database.collection("chat_rooms").document(room_id)
+    room = room_ref.get(transaction=transaction).to_dict()
+
+    cleared = room.get(field, 0)
+    identifier = room["partner_code"] if is_retailer else room["agent_code"]
+
+    transaction.update(room_ref, {field: 0})
+    if cleared:
+        transaction.set(total_ref(identifier), {field: firestore.Increment(-cleared)}, merge=True)
+
+    room[field] = 0
+    return room, cleared
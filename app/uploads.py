@@ -0,0 +1,173 @@
+import datetime
+import hashlib
+import os
+import uuid
+from fastapi import HTTPException, UploadFile
+from google.api_core.exceptions import NotFound
+from firebase_instance import bucket, run_storage
+from app.images import create_image_variants, stored_variant_urls, variant_urls
+
+
+UPLOAD_MAX_SIZE = 1024 * 1024 * 10
+UPLOAD_CHUNK_SIZE = 1024 * 256
+UPLOAD_TIMEOUT = 60
+
+# prefixes clients may upload to directly with a signed url
+UPLOAD_PREFIXES = {"attachments": "attachments/", "html_images": "html_images/"}
+SIGNED_URL_EXPIRATION = datetime.timedelta(minutes=15)
+# signed url uploads wait here until finalized, a bucket lifecycle rule deletes what is never finalized
+PENDING_UPLOAD_PREFIX = "pending_uploads/"
+PENDING_UPLOAD_MAX_AGE_DAYS = 1
+
+# set to a local storage stand-in (e.g. fake-gcs-server), signed urls then point at it too
+STORAGE_EMULATOR_HOST = os.environ.get("STORAGE_EMULATOR_HOST")
+
+
+async def store_upload(file: UploadFile, prefix: str) -> dict:
+    """Stores an uploaded file under prefix named by its sha256, returns filename and public path.
+
+    The file is read in chunks while hashing and checking the size, and is streamed to storage from
+    its spooled temp file. Content that is already stored is not uploaded again. Images also get
+    thumbnail_path / display_path variants, made in the background for new images (variants_ready).
+    """
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="File has no filename")
+
+    # starlette knows the size of the parsed part, too large files are refused before hashing
+    if file.size is not None and file.size > UPLOAD_MAX_SIZE:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    hasher = hashlib.sha256()
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > UPLOAD_MAX_SIZE:
+            raise HTTPException(status_code=413, detail="File is too large")
+        hasher.update(chunk)
+
+    digest = hasher.hexdigest()
+    filename = f"{digest}.{file.filename.split('.')[-1]}"
+    blob = bucket.blob(prefix + filename)
+
+    # same content was uploaded before, its url is reused and not uploaded again.
+    # reload instead of exists, its metadata also tells whether image variants are stored
+    try:
+        await run_storage(blob.reload)
+        stored = True
+    except NotFound:
+        stored = False
+
+    if not stored:
+        await file.seek(0)
+        await run_storage(blob.upload_from_file, file.file, content_type=file.content_type, size=size, timeout=UPLOAD_TIMEOUT)
+
+        # makes the blob publicly accessible
+        await run_storage(blob.make_public)
+
+    uploaded = {"filename": filename, "path": blob.public_url}
+
+    # compressed thumbnail / display variants for image previews. they are made in the background,
+    # until variants_ready their urls may not exist yet and clients fall back to path
+    if (file.content_type or "").startswith("image/"):
+        variants = stored_variant_urls(blob) if stored else {}
+        if variants:
+            uploaded.update({f"{name}_path": url for name, url in variants.items()})
+            uploaded["variants_ready"] = True
+        else:
+            # read whole only here, Pillow needs the full image
+            await file.seek(0)
+            if create_image_variants(await file.read(), prefix, digest, blob):
+                uploaded.update({f"{name}_path": url for name, url in variant_urls(prefix, digest).items()})
+                uploaded["variants_ready"] = False
+
+    return uploaded
+
+
+async def create_signed_upload(prefix: str, filename: str, content_type: str, sha256: str | None = None) -> dict:
+    """Returns a short-lived signed PUT url the client uploads to directly, then calls finalize_upload with path.
+
+    With the content's sha256, a blob stored by store_upload under that hash is returned instead and
+    no upload is needed. Direct uploads themselves get a random name, since the server never sees
+    their content to verify a hash.
+    """
+    if prefix not in UPLOAD_PREFIXES:
+        raise HTTPException(status_code=400, detail="Invalid upload prefix")
+
+    extension = filename.split(".")[-1]
+    if sha256:
+        if len(sha256) != 64 or any(char not in "0123456789abcdef" for char in sha256.lower()):
+            raise HTTPException(status_code=400, detail="Invalid sha256")
+
+        existing_blob = bucket.blob(f"{UPLOAD_PREFIXES[prefix]}{sha256.lower()}.{extension}")
+        if await run_storage(existing_blob.exists):
+            return {"exists": True, "filename": existing_blob.name.split("/")[-1], "path": existing_blob.public_url}
+
+    # staged under pending_uploads/ until finalize_upload checks and moves it, a client that never
+    # finalizes leaves it to the lifecycle rule
+    name = f"{uuid.uuid4()}.{extension}"
+    blob = bucket.blob(f"{PENDING_UPLOAD_PREFIX}{prefix}/{name}")
+
+    # storage refuses bodies outside the range, the client has to send the header with the PUT
+    upload_headers = {"Content-Type": content_type, "x-goog-content-length-range": f"0,{UPLOAD_MAX_SIZE}"}
+
+    signed_url = await run_storage(
+        blob.generate_signed_url,
+        version="v4",
+        expiration=SIGNED_URL_EXPIRATION,
+        method="PUT",
+        content_type=content_type,
+        headers={"x-goog-content-length-range": upload_headers["x-goog-content-length-range"]},
+        **({"api_access_endpoint": STORAGE_EMULATOR_HOST} if STORAGE_EMULATOR_HOST else {}),
+    )
+
+    return {
+        "exists": False,
+        "filename": name,
+        "object_path": blob.name,
+        "upload_url": signed_url,
+        "upload_headers": upload_headers,
+        "content_type": content_type,
+        "expires_in": int(SIGNED_URL_EXPIRATION.total_seconds()),
+    }
+
+
+async def finalize_upload(path: str) -> dict:
+    """Checks an object uploaded with a signed url (object_path of create_signed_upload), moves it to its prefix and makes it public"""
+    parts = path.split("/")
+    if len(parts) != 3 or f"{parts[0]}/" != PENDING_UPLOAD_PREFIX or parts[1] not in UPLOAD_PREFIXES or not parts[2] or ".." in path:
+        raise HTTPException(status_code=400, detail="Invalid upload path")
+
+    blob = bucket.blob(path)
+    try:
+        await run_storage(blob.reload)
+    except NotFound:
+        raise HTTPException(status_code=404, detail="Uploaded file not found")
+
+    # enforced by the signed url already, checked again in case the header was left out of the signature
+    if blob.size is None or blob.size > UPLOAD_MAX_SIZE:
+        await run_storage(blob.delete)
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    # server side copy, the content doesn't pass through here
+    final_blob = await run_storage(bucket.copy_blob, blob, bucket, UPLOAD_PREFIXES[parts[1]] + parts[2])
+    await run_storage(blob.delete)
+    await run_storage(final_blob.make_public)
+
+    return {"filename": parts[2], "path": final_blob.public_url}
+
+
+def ensure_pending_upload_lifecycle():
+    """Adds a bucket lifecycle rule deleting staged direct uploads after a day, if it isn't there yet.
+
+    Best effort, without bucket update permission the rule has to be added in the console.
+    """
+    try:
+        bucket.reload()
+        for rule in bucket.lifecycle_rules:
+            if PENDING_UPLOAD_PREFIX in rule.get("condition", {}).get("matchesPrefix", []):
+                return
+
+        bucket.add_lifecycle_delete_rule(age=PENDING_UPLOAD_MAX_AGE_DAYS, matches_prefix=[PENDING_UPLOAD_PREFIX])
+        bucket.patch()
+    except Exception as e:
+        print(f"Error adding lifecycle rule for {PENDING_UPLOAD_PREFIX}: {e}")
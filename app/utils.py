@@ -1,36 +1,73 @@
+import base64
 import datetime
-import requests
+import hashlib
+import json
+import httpx
 from firebase_admin import messaging
-from sensitive import ALI_GO_API_KEY, API_SERVER_URL
+from google.cloud.firestore_v1.base_document import DocumentSnapshot
+from app.auth_client import auth_client
+from app.cache import SingleFlight, TTLCache
+from firebase_instance import run_db
 import sys
 
 
-def get_user_info(access_token: str):
+# validated tokens are cached by hash so repeated requests with the same token skip the API server
+USER_INFO_CACHE_SIZE = 10000
+USER_INFO_TTL = 60
+REJECTED_TOKEN_TTL = 10
+
+user_info_cache = TTLCache(maxsize=USER_INFO_CACHE_SIZE, ttl=USER_INFO_TTL)
+user_info_flight = SingleFlight()
+
+
+async def get_user_info(access_token: str):
+    token_key = hashlib.sha256(str(access_token).encode()).hexdigest()
+
+    cached = user_info_cache.get(token_key)
+    if isinstance(cached, ValueError):
+        raise ValueError(str(cached))
+    if cached is not None:
+        return dict(cached)
+
+    # concurrent requests with the same token share one API call
+    user_info = await user_info_flight.do(token_key, lambda: _fetch_user_info(access_token, token_key))
+    return dict(user_info)
+
+
+async def _fetch_user_info(access_token: str, token_key: str):
     print("get user info API called")
     # sys.stdout.flush()
 
     try:
-        headers = {"Authorization": f"Bearer {access_token}"}
-        response = requests.get(API_SERVER_URL, headers=headers)
-
-        data = response.json()
-        info = data["data"]["info"]
+        info = await auth_client.fetch_info(access_token)
 
         agent_codes = info.get("agent_cd", [None])
         agent_code = None
         if agent_codes is not None and len(agent_codes) > 0:
             agent_code = agent_codes[0]
 
-        return {
+        user_info = {
             "username": info["username"],
             "roles": info.get("strRoles", []),
             "name": info["name"],
             "agent_code": agent_code,
             "is_retailer": "ROLE_AGENCY" in info.get("strRoles", []),
         }
+        user_info_cache.set(token_key, user_info)
+        return user_info
+
     except Exception as e:
         print("auth error AAAAA")
-        raise ValueError(f"유효하지 않거나 만료된 인증 토큰. Reason: {str(e)}")
+        error = ValueError(f"유효하지 않거나 만료된 인증 토큰. Reason: {str(e)}")
+
+        # network errors and 5xx are not the token's fault, so only rejections are cached
+        transient = isinstance(e, httpx.TransportError) or (
+            isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500
+        )
+        if not transient:
+            user_info_cache.set(token_key, error, ttl=REJECTED_TOKEN_TTL)
+
+        raise error
 
     # return {
     #     "username": "SM00001",
@@ -61,44 +98,6 @@ def send_notification(fcmToken, title, body, chat_room_id):
         return f"Error sending message: {e}"
 
 
-def send_multiple_notifications(fcm_tokens, title, body, chat_room_id):
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        data={
-            # "room": room,
-            "chat_room_id": chat_room_id,
-        },
-        tokens=fcm_tokens,
-    )
-
-    try:
-        response = messaging.send_multicast(message)
-        return f"Successfully sent messages: {response.success_count} successful, {response.failure_count} failed"
-    except Exception as e:
-        return f"Error sending messages: {e}"
-
-
-def send_single_sms(receiver_phone_number, title, message):
-    send_url = "https://apis.aligo.in/send/"  # 요청을 던지는 URL, 현재는 문자보내기
-    # API key, userid, sender, receiver, msg
-    # API키, 알리고 사이트 아이디, 발신번호, 수신번호, 문자내용
-    sms_data = {
-        "key": ALI_GO_API_KEY,  # api key
-        "userid": "simpass",  # 알리고 사이트 아이디
-        "sender": "0221083121",  # 발신번호
-        "receiver": receiver_phone_number,  # 수신번호 (,활용하여 1000명까지 추가 가능)
-        "msg": message,  # 문자 내용
-        "msg_type": "LMS",  # 메세지 타입 (SMS, LMS)
-        "title": title,  # 메세지 제목 (장문에 적용)
-    }
-
-    send_response = requests.post(send_url, data=sms_data)
-    print(send_response.json())
-
-
 def format_date(date: datetime.datetime) -> str | None:
     # datetime.datetime.fromtimestamp(html.get("createdAt").timestamp())
 
@@ -121,3 +120,37 @@ def to_datetime(date: str) -> datetime:
     except Exception as e:
         print(f"Error formatting to datetime: {e}")
         return None
+
+
+def encode_page_token(last_doc_id: str, num: int = 0, sort_value: datetime.datetime | None = None) -> str:
+    # opaque keyset cursor: id and sort key of the last document of the page and how many rows came before the next page
+    data = {"after": last_doc_id, "num": num}
+    if isinstance(sort_value, datetime.datetime):
+        data["sort"] = sort_value.isoformat()
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_page_token(page_token: str) -> tuple[str, int, datetime.datetime | None]:
+    # sort value is None for tokens made before it was included
+    try:
+        raw = base64.urlsafe_b64decode(page_token + "=" * (-len(page_token) % 4))
+        data = json.loads(raw)
+        sort_value = datetime.datetime.fromisoformat(data["sort"]) if data.get("sort") else None
+        return str(data["after"]), int(data.get("num", 0)), sort_value
+    except Exception:
+        raise ValueError("Invalid page token")
+
+
+async def page_cursor(collection_ref, doc_id: str, sort_field: str, sort_value: datetime.datetime | None):
+    """start_after cursor for a keyset page, built from the token without reading the document.
+
+    A snapshot (not a plain dict) so firestore also orders ties by document id. Old tokens without
+    the sort value read only that field. Returns None when the document is gone.
+    """
+    doc_ref = collection_ref.document(doc_id)
+    if sort_value is not None:
+        return DocumentSnapshot(doc_ref, {sort_field: sort_value}, True, None, None, None)
+
+    snapshot = await run_db(doc_ref.get, field_paths=[sort_field])
+    return snapshot if snapshot.exists else None
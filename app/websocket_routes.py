@@ -1,10 +1,12 @@
 import datetime
 from typing import Optional
 from fastapi import APIRouter, WebSocket
-from app.chat_endpoints import send_multiple_notifications
-from websocket_manager import manager
+from app.notifications import notification_dispatcher, register_fcm_token
+from websocket_manager import BATCH_SUBPROTOCOL, manager
 from app.utils import format_date, get_user_info
-from firebase_instance import database
+from app.chat_cache import RECENT_CHATS_PER_ROOM, recent_chats
+from app.unread_counts import apply_local_delta, get_total_unread_count, increment_unread, reset_room_unread_count, unread_field
+from firebase_instance import database, run_db
 from google.cloud.firestore_v1.base_query import FieldFilter
 from firebase_admin import firestore
 import sys
@@ -12,6 +14,9 @@ import sys
 
 router = APIRouter()
 
+# number of chats sent per room_chats / older_chats page, same as the in-memory buffer so a buffered room is a full page
+CHAT_PAGE_SIZE = RECENT_CHATS_PER_ROOM
+
 
 @router.websocket("/ws/{access_token}")
 async def websocket_endpoint(websocket: WebSocket, access_token: str):
@@ -25,11 +30,13 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
             return
 
         # Get user info before accepting connection
-        user_info = get_user_info(access_token)
+        user_info = await get_user_info(access_token)
         is_retailer = user_info["is_retailer"]
         identifier = user_info["username"] if is_retailer else user_info["agent_code"]
 
-        await websocket.accept()
+        # batch protocol is opt-in, negotiated by subprotocol or ?batch=1
+        batching = BATCH_SUBPROTOCOL in websocket.scope.get("subprotocols", []) or websocket.query_params.get("batch") in ["1", "true"]
+        await websocket.accept(subprotocol=BATCH_SUBPROTOCOL if BATCH_SUBPROTOCOL in websocket.scope.get("subprotocols", []) else None)
 
     except Exception as e:
         print(e)
@@ -38,11 +45,11 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
 
     try:
         # Connect to manager
-        await manager.connect(websocket, identifier)
+        await manager.connect(websocket, identifier, batching=batching)
 
         # sending total count when initial connection established
-        total_count = get_total_unread_count(is_retailer, identifier)
-        await websocket.send_json({"type": "total_count", "total_unread_count": total_count})
+        total_count = await get_total_unread_count(is_retailer, identifier)
+        await manager.send_json(websocket, {"type": "total_count", "total_unread_count": total_count})
 
         while True:
 
@@ -58,8 +65,8 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
 
             if action == "update_fcm_token":
                 fcm_token = response.get("fcmToken", None)
-                agent_ref = database.collection("users").document(identifier)
-                agent_ref.set({"fcm_tokens": firestore.ArrayUnion([fcm_token])}, merge=True)
+                if fcm_token:
+                    await register_fcm_token(identifier, fcm_token)
 
             if action == "get_chat_rooms":
                 rooms = []
@@ -67,7 +74,7 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
 
                 search_field = "partner_code" if is_retailer else "agent_code"
 
-                rooms_ref = database.collection("chat_rooms").where(filter=FieldFilter(search_field, "==", identifier)).get()
+                rooms_ref = await run_db(database.collection("chat_rooms").where(filter=FieldFilter(search_field, "==", identifier)).get)
 
                 for room_ref in rooms_ref:
                     room_id = room_ref.id
@@ -96,12 +103,12 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
                     manager.disconnect(identifier)
                     return
 
-                chat_rooms_ref = (
+                chat_rooms_ref = await run_db(
                     database.collection("chat_rooms")
                     .where(filter=FieldFilter("partner_code", "==", partner_code))
                     .where(filter=FieldFilter("agent_code", "==", agent_code))
                     .limit(1)
-                    .get()
+                    .get
                 )
 
                 if len(chat_rooms_ref) > 0:
@@ -113,35 +120,42 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
                 else:
                     room_id, room_info = await add_new_room(agent_code=agent_code, partner_code=partner_code, partner_name=partner_name)
 
-                chats = get_room_chats(room_id)
-                await websocket.send_json({"type": "room_chats", "chats": chats, "room_id": room_id, "room_info": room_info})
+                manager.set_room(websocket, room_id)
+                chats, has_more = await get_latest_room_chats(room_id)
+                await manager.send_json(websocket, {"type": "room_chats", "chats": chats, "room_id": room_id, "room_info": room_info, "has_more": has_more})
 
             if action == "join_room":
                 room_id = response.get("roomId", None)
 
-                chats = get_room_chats(room_id)
-                await websocket.send_json({"type": "room_chats", "chats": chats, "room_id": room_id, "room_info": None})
+                manager.set_room(websocket, room_id)
+                chats, has_more = await get_latest_room_chats(room_id)
+                await manager.send_json(websocket, {"type": "room_chats", "chats": chats, "room_id": room_id, "room_info": None, "has_more": has_more})
+
+            # client closed the room screen, notifications of the room are sent again
+            if action == "leave_room":
+                manager.set_room(websocket, None)
+
+            # older page of a room, before the oldest chat client already has
+            if action == "load_older":
+                room_id = response.get("roomId", None)
+                before_chat_id = response.get("beforeChatId", None)
+
+                chats, has_more = await get_room_chats(room_id, before_chat_id)
+                await manager.send_json(websocket, {"type": "older_chats", "chats": chats, "room_id": room_id, "has_more": has_more})
 
             if action == "reset_room_unread_count":
                 room_id = response.get("roomId")
                 # print(room_id)
-                chat_room_ref = database.collection("chat_rooms").document(room_id)
-                update_field = "partner_unread_count" if is_retailer else "agent_unread_count"
-                chat_room_ref.update({update_field: 0})
-
-                # emitting room unread_count
-                chat_room = chat_room_ref.get().to_dict()
+                # room counter and identifier total are reset in one transaction
+                chat_room = await reset_room_unread_count(room_id, is_retailer)
 
                 # emit room modified after each new chat
-                await manager.send_json_to_identifier(
-                    content={"type": "room_modified", "modified_room": chat_room}, identifier=chat_room["agent_code"]
-                )
-                await manager.send_json_to_identifier(
-                    content={"type": "room_modified", "modified_room": chat_room}, identifier=chat_room["partner_code"]
+                await manager.send_json_to_identifiers(
+                    content={"type": "room_modified", "modified_room": chat_room}, identifiers=[chat_room["agent_code"], chat_room["partner_code"]]
                 )
 
                 # whenever room unread count reset total unread count also reset
-                total_count = get_total_unread_count(is_retailer, identifier)
+                total_count = await get_total_unread_count(is_retailer, identifier)
                 await manager.send_json_to_identifier(content={"type": "total_count", "total_unread_count": total_count}, identifier=identifier)
 
             # when partner sends a new message
@@ -151,18 +165,8 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
                 text = response["text"]
                 attachment_paths = response["attachmentPaths"]
 
-                # first getting room details by room id and then creating a new message
-                chat_room_ref = database.collection("chat_rooms").document(room_id)
-                room_details = chat_room_ref.get().to_dict()
-                # print(room_details)
-
-                agent_code = room_details["agent_code"]
-                partner_code = room_details["partner_code"]
-
                 new_chat = {
                     "room_id": room_id,
-                    "sender": partner_code if is_retailer else agent_code,
-                    "receiver": agent_code if is_retailer else partner_code,
                     "is_retailer": is_retailer,
                     # "timestamp": datetime.datetime.now(datetime.timezone.utc),
                     "timestamp": datetime.datetime.now(),
@@ -177,64 +181,34 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
                         "name": user_info["name"],
                     }
 
-                database.collection("chats").add(new_chat)
-                new_chat["timestamp"] = format_date(new_chat["timestamp"])
+                # room read, chat write and unread counters commit in one transaction, the room is not re-read
+                chat_room = await run_db(_commit_new_chat, database.transaction(), room_id, new_chat, is_retailer)
 
-                # emitting new chat to both sender and receiver
-                await manager.send_json_to_identifier(content={"type": "new_chat", "new_chat": new_chat}, identifier=partner_code)
-                await manager.send_json_to_identifier(content={"type": "new_chat", "new_chat": new_chat}, identifier=agent_code)
+                agent_code = chat_room["agent_code"]
+                partner_code = chat_room["partner_code"]
+                receiver_code = agent_code if is_retailer else partner_code
+                # the receiver's total_count is pushed from memory by the workers holding its sockets
+                await apply_local_delta(not is_retailer, receiver_code, 1, push_total=True)
 
-                # update unread count of receiver
-                update_field = "agent_unread_count" if is_retailer else "partner_unread_count"
-                chat_room_ref.update({update_field: firestore.Increment(1)})
-
-                # need to get room details again after changes
-                chat_room = chat_room_ref.get().to_dict()
-                # print(chat_room)
-
-                # after each new message emit total_count
-                await manager.send_json_to_identifier(
-                    content={"type": "total_count", "total_unread_count": chat_room["partner_unread_count"]}, identifier=partner_code
-                )
+                new_chat["timestamp"] = format_date(new_chat["timestamp"])
+                await manager.broadcast_event("chat_added", {"room_id": room_id, "chat": new_chat})
 
-                await manager.send_json_to_identifier(
-                    content={"type": "total_count", "total_unread_count": chat_room["agent_unread_count"]}, identifier=agent_code
-                )
+                # emitting new chat to both sender and receiver
+                await manager.send_json_to_identifiers(content={"type": "new_chat", "new_chat": new_chat}, identifiers=[partner_code, agent_code])
 
                 # emit room modified after each new chat
-                await manager.send_json_to_identifier(content={"type": "room_modified", "modified_room": chat_room}, identifier=agent_code)
-                await manager.send_json_to_identifier(content={"type": "room_modified", "modified_room": chat_room}, identifier=partner_code)
+                await manager.send_json_to_identifiers(content={"type": "room_modified", "modified_room": chat_room}, identifiers=[agent_code, partner_code])
 
+                # notification is sent in the background, token lookup included
                 if is_retailer:
-                    # notification is sent here
+                    # when partner sends message, agent receives notification
                     if agent_code is not None:
-                        # when partner sends message, agent receives notification
-                        agent_ref = database.collection("users").document(agent_code).get()
-                        if agent_ref.exists:
-                            fcm_tokens = agent_ref.to_dict()["fcm_tokens"]
-                            name = user_info["name"]
-                            if len(fcm_tokens) > 0:
-                                send_multiple_notifications(
-                                    fcm_tokens=fcm_tokens,
-                                    title=f"{name}이 메시지를 보냈어요!",
-                                    body=text,
-                                    chat_room_id=room_id,
-                                )
+                        notification_dispatcher.notify(agent_code, title=f"{user_info['name']}이 메시지를 보냈어요!", body=text, chat_room_id=room_id)
 
                 else:
-                    # notification is sent here
+                    # when agent sends message, partner receives notification
                     if partner_code is not None:
-                        # when agent sends message, partner receives notification
-                        partner_ref = database.collection("users").document(partner_code).get()
-                        if partner_ref.exists:
-                            fcm_tokens = partner_ref.to_dict()["fcm_tokens"]
-                            if len(fcm_tokens) > 0:
-                                send_multiple_notifications(
-                                    fcm_tokens=fcm_tokens,
-                                    title=f"메시지를 받았습니다",
-                                    body=text,
-                                    chat_room_id=room_id,
-                                )
+                        notification_dispatcher.notify(partner_code, title="메시지를 받았습니다", body=text, chat_room_id=room_id)
 
     except Exception as e:
         print(e)
@@ -246,13 +220,71 @@ async def websocket_endpoint(websocket: WebSocket, access_token: str):
         await cleanup_connection(websocket, identifier)
 
 
-def get_room_chats(room_id: str):
-    chats_ref = (
-        database.collection("chats")
-        .where(filter=FieldFilter("room_id", "==", room_id))
-        .order_by("timestamp", direction=firestore.Query.ASCENDING)
-        .get()
-    )
+@firestore.transactional
+def _commit_new_chat(transaction, room_id: str, new_chat: dict, is_retailer: bool) -> dict:
+    # fills sender / receiver of new_chat, writes it with the receiver's counter increments
+    # and returns the room with the counts it has after the commit
+    chat_room_ref = database.collection("chat_rooms").document(room_id)
+    chat_room = chat_room_ref.get(transaction=transaction).to_dict()
+
+    agent_code = chat_room["agent_code"]
+    partner_code = chat_room["partner_code"]
+    receiver_code = agent_code if is_retailer else partner_code
+
+    chat_ref = database.collection("chats").document()
+    new_chat["sender"] = partner_code if is_retailer else agent_code
+    new_chat["receiver"] = receiver_code
+    transaction.set(chat_ref, {key: value for key, value in new_chat.items() if key != "chat_id"})
+    new_chat["chat_id"] = chat_ref.id
+
+    increment_unread(transaction, chat_room_ref, not is_retailer, receiver_code)
+
+    update_field = unread_field(not is_retailer)
+    chat_room[update_field] = chat_room.get(update_field, 0) + 1
+    return chat_room
+
+
+async def _on_chat_added(data: dict):
+    # buffers of every worker get the new chat, wherever it was written
+    recent_chats.append(data["room_id"], data["chat"])
+
+
+manager.on_event("chat_added", _on_chat_added)
+
+
+async def get_latest_room_chats(room_id: str):
+    # latest page of a room, served from the in-memory buffer when the room is hot
+    cached = recent_chats.get(room_id)
+    if cached is not None:
+        return cached
+
+    recent_chats.begin_load(room_id)
+    try:
+        chats, has_more = await get_room_chats(room_id)
+    except Exception:
+        recent_chats.cancel_load(room_id)
+        raise
+
+    recent_chats.fill(room_id, chats, has_more)
+    return chats, has_more
+
+
+async def get_room_chats(room_id: str, before_chat_id: Optional[str] = None, page_size: int = CHAT_PAGE_SIZE):
+    # returns the latest page_size chats of the room (older than before_chat_id if given) in ascending order
+    # and whether older chats exist. one extra chat is fetched to know has_more without a count query
+    query = database.collection("chats").where(filter=FieldFilter("room_id", "==", room_id)).order_by("timestamp", direction=firestore.Query.ASCENDING)
+
+    if before_chat_id:
+        cursor_ref = await run_db(database.collection("chats").document(before_chat_id).get)
+        if not cursor_ref.exists or cursor_ref.get("room_id") != room_id:
+            return [], False
+        query = query.end_before(cursor_ref)
+
+    chats_ref = await run_db(query.limit_to_last(page_size + 1).get)
+
+    has_more = len(chats_ref) > page_size
+    if has_more:
+        chats_ref = chats_ref[1:]
 
     chats = []
     for chat_ref in chats_ref:
@@ -263,25 +295,7 @@ def get_room_chats(room_id: str):
         chats.append(chat)
 
     # print(chats)
-    return chats
-
-
-def get_total_unread_count(is_retailer: bool, identifier: str):
-    # return fll chat rooms total_unread_counts of given identifier (agent code or partner code)
-    total_unread_count = 0
-
-    search_field = "partner_code" if is_retailer else "agent_code"
-    find_field = "partner_unread_count" if is_retailer else "agent_unread_count"
-
-    rooms_ref = database.collection("chat_rooms").where(filter=FieldFilter(search_field, "==", identifier)).get()
-    for room_ref in rooms_ref:
-        room = room_ref.to_dict()
-        total_unread_count += room.get(find_field, 0)
-
-    print(total_unread_count)
-    # sys.stdout.flush()
-
-    return total_unread_count
+    return chats, has_more
 
 
 async def add_new_room(agent_code: str, partner_code: str, partner_name: str = None) -> str:
@@ -301,11 +315,10 @@ async def add_new_room(agent_code: str, partner_code: str, partner_name: str = N
     }
 
     # set the data for the document
-    doc_ref.set(new_room)
+    await run_db(doc_ref.set, new_room)
 
     # emitting new room to both sender and receiver
-    await manager.send_json_to_identifier(content={"type": "room_added", "new_room": new_room}, identifier=partner_code)
-    await manager.send_json_to_identifier(content={"type": "room_added", "new_room": new_room}, identifier=agent_code)
+    await manager.send_json_to_identifiers(content={"type": "room_added", "new_room": new_room}, identifiers=[partner_code, agent_code])
 
     # return new_room
     return room_id, new_room
@@ -1,3 +1,6 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import credentials, storage, firestore
 
@@ -9,3 +12,31 @@ firebase_admin.initialize_app(cred, {"storageBucket": FIREBASE_BUCKET})
 
 database = firestore.client()
 bucket = storage.bucket()
+
+
+# firestore client is blocking, so every call goes through this bounded pool instead of the event loop
+DB_MAX_WORKERS = 16
+DB_TIMEOUT = 10
+
+db_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix="firestore")
+
+
+async def run_db(func, *args, timeout: float = DB_TIMEOUT, **kwargs):
+    """Runs a blocking firestore call in the db pool and awaits it with a timeout"""
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs)), timeout)
+
+
+# cloud storage transfers take much longer than firestore calls, they get their own pool so a burst of
+# uploads can't hold up chat reads and writes
+STORAGE_MAX_WORKERS = 8
+# backstop only, calls pass their own library timeout
+STORAGE_TIMEOUT = 120
+
+storage_executor = ThreadPoolExecutor(max_workers=STORAGE_MAX_WORKERS, thread_name_prefix="storage")
+
+
+async def run_storage(func, *args, **kwargs):
+    """Runs a blocking cloud storage call in the storage pool, every keyword argument (timeout too) goes to func"""
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(loop.run_in_executor(storage_executor, functools.partial(func, *args, **kwargs)), STORAGE_TIMEOUT)
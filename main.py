@@ -1,6 +1,29 @@
 # /main.py
 
 import json
+import os
+import sys
+
+if __name__ == "__main__":
+    # python main.py hands over to `python -m uvicorn main:app` before importing the app, with main.py
+    # as __main__ every process pool worker would re-run it (and initialize firebase) on start.
+    # uvicorn only spawns workers from an import string anyway
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+        "--host", "0.0.0.0",
+        "--port", "8000",
+        "--workers", os.environ.get("WEB_CONCURRENCY", "1"),
+        "--limit-concurrency", "500",  # Start with this limit
+        "--backlog", "100",
+        "--loop", "uvloop",  # Use uvloop for better performance
+        "--http", "httptools",  # Faster HTTP parsing
+        "--ws-max-size", "16777216",  # 16MB max WebSocket message size
+        "--ws-ping-interval", "20",  # Keep connections alive
+        "--ws-ping-timeout", "30",
+    ])
+
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,9 +33,38 @@ from app.chat_endpoints import router as api_router
 from app.websocket_routes import router as websocket_router
 from app.html_edtor_endpoints import router as html_router
 from app.order_usim_endpoints import router as usim_router
-
-
-app = FastAPI()
+from app.auth_client import auth_client
+from app.fast_json import FastJSONResponse
+from firebase_instance import db_executor, run_storage, storage_executor
+from websocket_manager import BACKPLANE_URL, manager
+from app.notifications import notification_dispatcher
+from app.sms import sms_dispatcher
+from app.images import shutdown_image_pool
+from app.html_compress import shutdown_compress_pool
+from app.uploads import ensure_pending_upload_lifecycle
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # joins the cross-worker fan-out backplane
+    await manager.start()
+    await notification_dispatcher.start()
+    await sms_dispatcher.start()
+    await run_storage(ensure_pending_upload_lifecycle)
+    yield
+    await sms_dispatcher.close()
+    await notification_dispatcher.close()
+    await manager.close()
+    # closes pooled keep-alive connections to the auth server
+    await auth_client.close()
+    db_executor.shutdown(wait=False)
+    storage_executor.shutdown(wait=False)
+    shutdown_image_pool()
+    shutdown_compress_pool()
+
+
+# every route that returns plain data is rendered with the fast encoder
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 
 # CORS
@@ -55,20 +107,10 @@ app.include_router(usim_router)
 #     uvicorn.run(app, host="0.0.0.0", port=8000)
 
 
-import uvicorn
+# more than 1 worker needs CHAT_BACKPLANE_URL so messages reach sockets held by other workers
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
 
+# checked on import, so every worker refuses to start instead of silently losing cross-worker messages
+if WORKERS > 1 and not BACKPLANE_URL:
+    raise RuntimeError("WEB_CONCURRENCY > 1 requires CHAT_BACKPLANE_URL")
 
-if __name__ == "__main__":
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=8000,
-        workers=1,  # Stick to 1 worker for single CPU
-        limit_concurrency=500,  # Start with this limit
-        backlog=100,
-        loop="uvloop",  # Use uvloop for better performance
-        http="httptools",  # Faster HTTP parsing
-        ws_max_size=16777216,  # 16MB max WebSocket message size
-        ws_ping_interval=20,  # Keep connections alive
-        ws_ping_timeout=30,
-    )
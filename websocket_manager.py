@@ -1,27 +1,242 @@
-from typing import Dict, List
+import asyncio
+import os
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
 from fastapi import WebSocket
+from app.backplane import Backplane, create_backplane
+from app.fast_json import dumps
+
+
+# redis://host:port to fan out between workers / nodes, unset for a single process
+BACKPLANE_URL = os.environ.get("CHAT_BACKPLANE_URL")
+
+# outbound queue per socket, what happens when a slow client lets it fill up:
+# "drop_oldest" drops the oldest frame, "coalesce" replaces an older frame of the same state
+# (total_count, room_modified of one room) and otherwise drops the oldest, "disconnect" closes the socket
+OUTBOUND_QUEUE_SIZE = 256
+OUTBOUND_QUEUE_POLICY = "coalesce"
+SEND_TIMEOUT = 10
+
+# close code for sockets dropped by the "disconnect" policy (try again later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# batch protocol mode: frames queued within one tick go out as one {"type": "batch", "events": [...]} frame
+BATCH_SUBPROTOCOL = "chat.batch.v1"
+BATCH_WINDOW = 0.01
+BATCH_MAX_EVENTS = 100
+
+
+def coalesce_key(content: dict) -> Optional[str]:
+    # frames that only carry the latest state, an older queued one can be replaced by a newer one
+    content_type = content.get("type")
+    if content_type == "total_count":
+        return "total_count"
+    if content_type == "room_modified":
+        return f"room_modified:{(content.get('modified_room') or {}).get('room_id')}"
+    return None
+
+
+class Connection:
+    """One websocket with its bounded outbound queue drained by its own writer task"""
+
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, identifier: str, max_size: int, policy: str, batching: bool):
+        self.manager = manager
+        self.websocket = websocket
+        self.identifier = identifier
+        self.max_size = max_size
+        self.policy = policy
+        self.batching = batching
+        self.room_id: Optional[str] = None  # room the client has open
+
+        self.queue: deque = deque()  # (coalesce key, encoded frame)
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.writer_task = asyncio.create_task(self._writer())
+
+    def enqueue(self, text: str, key: Optional[str] = None):
+        if self.closed:
+            return
+
+        if len(self.queue) >= self.max_size:
+            if self.policy == "disconnect":
+                self.closed = True
+                self.manager.slow_disconnects += 1
+                asyncio.create_task(self._disconnect(code=SLOW_CONSUMER_CLOSE_CODE, reason="Slow consumer"))
+                return
+
+            if not (self.policy == "coalesce" and key is not None and self._remove_key(key)):
+                self.queue.popleft()
+            self.dropped += 1
+
+        self.queue.append((key, text))
+        self.ready.set()
+
+    def _remove_key(self, key) -> bool:
+        for index, (queued_key, _) in enumerate(self.queue):
+            if queued_key == key:
+                del self.queue[index]
+                return True
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                await self.ready.wait()
+                if self.batching:
+                    # lets the rest of the current action's events join the same frame
+                    await asyncio.sleep(BATCH_WINDOW)
+
+                while self.queue:
+                    await asyncio.wait_for(self.websocket.send_text(self._next_frame()), SEND_TIMEOUT)
+                    self.sent += 1
+                self.ready.clear()
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # broken or stalled socket is removed instead of staying in active connections
+            print(f"Error sending to socket: {e}")
+            await self.close()
+
+    def _next_frame(self) -> str:
+        if not self.batching or len(self.queue) == 1:
+            return self.queue.popleft()[1]
+
+        # events are already encoded, so the envelope is built without decoding them
+        count = min(len(self.queue), BATCH_MAX_EVENTS)
+        events = [self.queue.popleft()[1] for _ in range(count)]
+        return '{"type":"batch","events":[' + ",".join(events) + "]}"
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None):
+        if self.closed:
+            return
+        self.closed = True
+        await self._disconnect(code, reason)
+
+    async def _disconnect(self, code: int, reason: Optional[str]):
+        self.manager.disconnect(self.websocket, self.identifier)
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        if self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
 
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+    def __init__(self, backplane: Backplane):
+        self.active_connections: Dict[str, List[Connection]] = {}
+        self.connections: Dict[WebSocket, Connection] = {}
+        self.slow_disconnects = 0
+        self.backplane = backplane
+        self.node_id = uuid.uuid4().hex
+        self.event_handlers: Dict[str, Callable[[dict], Awaitable[None]]] = {}
+
+    async def start(self):
+        await self.backplane.start(self._on_backplane_message)
+
+    async def close(self):
+        await self.backplane.close()
+
+    async def connect(self, websocket: WebSocket, identifier: str, policy: str = OUTBOUND_QUEUE_POLICY, batching: bool = False):
+        connection = Connection(self, websocket, identifier, max_size=OUTBOUND_QUEUE_SIZE, policy=policy, batching=batching)
+        self.connections[websocket] = connection
 
-    async def connect(self, websocket: WebSocket, identifier: str):
         if identifier not in self.active_connections:
             self.active_connections[identifier] = []
-        self.active_connections[identifier].append(websocket)
+        self.active_connections[identifier].append(connection)
 
     def disconnect(self, websocket: WebSocket, identifier: str):
+        connection = self.connections.pop(websocket, None)
+        if connection is not None:
+            connection.stop()
+
         if identifier in self.active_connections:
-            self.active_connections[identifier] = [conn for conn in self.active_connections[identifier] if conn != websocket]
+            self.active_connections[identifier] = [conn for conn in self.active_connections[identifier] if conn.websocket != websocket]
             if not self.active_connections[identifier]:
                 del self.active_connections[identifier]
             print("socket disconnected")
 
+    def set_room(self, websocket: WebSocket, room_id: Optional[str]):
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.room_id = room_id
+
+    def is_in_room(self, identifier: str, room_id: str) -> bool:
+        # only sockets of this worker are known, elsewhere it's treated as not in the room
+        return any(connection.room_id == room_id for connection in self.active_connections.get(identifier, []))
+
+    async def send_json(self, websocket: WebSocket, content: dict):
+        # goes through the socket's queue so it stays in order with broadcasts
+        connection = self.connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(dumps(content), coalesce_key(content))
+
     async def send_json_to_identifier(self, content: dict, identifier: str):
-        if identifier in self.active_connections:
-            for connection in self.active_connections[identifier]:
-                await connection.send_json(content)
+        await self.send_json_to_identifiers(content, [identifier])
+
+    async def send_json_to_identifiers(self, content: dict, identifiers: List[str]):
+        # encoded once, the same text frame goes to every socket of every identifier
+        text = dumps(content)
+        key = coalesce_key(content)
+        identifiers = list(dict.fromkeys(identifier for identifier in identifiers if identifier))
+
+        # local sockets first, then every other worker delivers to its own sockets
+        self._send_local(text, key, identifiers)
+        await self.backplane.publish({"node": self.node_id, "kind": "send", "identifiers": identifiers, "text": text, "key": key})
+
+    def send_json_local(self, content: dict, identifiers: List[str]):
+        # sockets of this worker only, for events every worker handles on its own
+        self._send_local(dumps(content), coalesce_key(content), identifiers)
+
+    def _send_local(self, text: str, key: Optional[str], identifiers: List[str]):
+        # only enqueues, every socket's writer sends on its own so one slow client can't hold up the rest
+        for identifier in identifiers:
+            for connection in self.active_connections.get(identifier, []):
+                connection.enqueue(text, key)
+
+    def stats(self) -> dict:
+        depths = [len(connection.queue) for connection in self.connections.values()]
+        return {
+            "identifiers": len(self.active_connections),
+            "connections": len(depths),
+            "queued": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "sent": sum(connection.sent for connection in self.connections.values()),
+            "dropped": sum(connection.dropped for connection in self.connections.values()),
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+    def on_event(self, kind: str, handler: Callable[[dict], Awaitable[None]]):
+        """Registers a handler for events published with broadcast_event on any worker"""
+        self.event_handlers[kind] = handler
+
+    async def broadcast_event(self, kind: str, data: dict):
+        # keeps per worker in-memory state (caches, waiters) in step across workers
+        handler = self.event_handlers.get(kind)
+        if handler is not None:
+            await handler(data)
+        await self.backplane.publish({"node": self.node_id, "kind": kind, "data": data})
+
+    async def _on_backplane_message(self, message: dict):
+        if message.get("node") == self.node_id:
+            return
+
+        kind = message.get("kind")
+        if kind == "send":
+            self._send_local(message["text"], message.get("key"), message["identifiers"])
+            return
+
+        handler = self.event_handlers.get(kind)
+        if handler is not None:
+            await handler(message.get("data") or {})
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(create_backplane(BACKPLANE_URL))